@@ -0,0 +1,105 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from libs.utils import human_time
+from collections import defaultdict
+from uuid import uuid4
+import subprocess
+import tempfile
+import tarfile
+import hashlib
+import shutil
+import stat
+import os
+
+
+# 增量传输：以主机上当前版本目录为基准，仅上传内容有变化的文件，其余文件在主机本地复制
+class DeltaPacker:
+    control_dir = '.spug_delta'
+
+    def __init__(self, tar_file, work_dir):
+        self.work_dir = tempfile.mkdtemp(dir=work_dir)
+        self.src_dir = os.path.join(self.work_dir, 'src')
+        os.makedirs(self.src_dir)
+        subprocess.run(['tar', 'xzf', tar_file, '-C', self.src_dir, '--strip-components=1'], check=True)
+        self.files, self.others = {}, []
+        for root, dirs, files in os.walk(self.src_dir):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, self.src_dir)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode) and '\n' not in rel_path and '\\' not in rel_path:
+                    self.files[rel_path] = (self._sha256(path), stat.S_IMODE(st.st_mode))
+                else:
+                    self.others.append(rel_path)
+        self.manifest = ''.join(f'{v[0]}  {k}\n' for k, v in self.files.items())
+
+    @staticmethod
+    def _sha256(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def transfer(self, helper, host, ssh, dst_repo, prev_version, spug_version):
+        tmp_file = f'/tmp/spug.{uuid4().hex}'
+        ssh.put_file_content(self.manifest, f'{tmp_file}.manifest')
+        # 固定为 C 语言环境，避免 sha256sum 输出本地化的 OK 导致解析失败
+        command = f'cd {dst_repo}/{prev_version} && LC_ALL=C sha256sum -c {tmp_file}.manifest 2> /dev/null '
+        command += f'| sed -n "s/: OK$//p" > {tmp_file}.ok; rm -f {tmp_file}.manifest'
+        ssh.exec_command_raw(command)
+        reused = set(ssh.get_file_content(f'{tmp_file}.ok').decode().splitlines()) & self.files.keys()
+        changed = [x for x in self.files if x not in reused]
+
+        modes = defaultdict(list)
+        for path in reused:
+            modes[self.files[path][1]].append(path)
+        delta_file = os.path.join(self.work_dir, f'{uuid4().hex}.tar.gz')
+        try:
+            with tarfile.open(delta_file, 'w:gz') as tar:
+                for path in self.others + changed:
+                    tar.add(os.path.join(self.src_dir, path), path, recursive=False)
+                self._add_control(tar, 'copy', '\0'.join(reused))
+                for mode, paths in modes.items():
+                    self._add_control(tar, f'mode_{mode:o}', '\0'.join(paths))
+            size = os.path.getsize(delta_file)
+            helper.send_info(host.id, f'\r\n{human_time()} 增量传输 {len(changed)} 个文件，复用 {len(reused)} 个文件')
+            ssh.put_file(delta_file, f'{tmp_file}.tar.gz', helper.progress_callback(host.id))
+        finally:
+            os.remove(delta_file)
+
+        command = f'cd {dst_repo} && rm -rf {spug_version} && mkdir {spug_version} && '
+        command += f'tar xzf {tmp_file}.tar.gz -C {spug_version} && '
+        command += f'(cd {prev_version} && tar cf - --null --no-recursion -T ../{spug_version}/{self.control_dir}/copy) '
+        command += f'| tar xf - -C {spug_version} && cd {spug_version} && '
+        command += f'for f in {self.control_dir}/mode_*; do [ -f "$f" ] && xargs -0 -r chmod ${{f##*_}} < "$f"; done; '
+        command += f'rm -rf {self.control_dir}'
+        code, out = ssh.exec_command_raw(f'{command}; code=$?; rm -f {tmp_file}.*; exit $code')
+        if code != 0:
+            raise RuntimeError(out.strip() or f'exit code: {code}')
+        return size
+
+    def cleanup(self):
+        shutil.rmtree(self.work_dir, True)
+
+    def _add_control(self, tar, name, content):
+        path = os.path.join(self.work_dir, uuid4().hex)
+        try:
+            with open(path, 'w') as f:
+                f.write(content)
+            tar.add(path, f'{self.control_dir}/{name}')
+        finally:
+            os.remove(path)
+
+
+def find_prev_version(ssh, dst_dir, dst_repo, deploy_id, spug_version):
+    code, out = ssh.exec_command_raw(f'readlink {dst_dir}')
+    target = out.strip()
+    if code != 0 or os.path.dirname(target) != dst_repo.rstrip('/'):
+        return None
+    prev_version = os.path.basename(target)
+    if prev_version == spug_version or not prev_version.startswith(f'{deploy_id}_'):
+        return None
+    code, _ = ssh.exec_command_raw(f'[ -d {target} ]')
+    return prev_version if code == 0 else None
@@ -0,0 +1,83 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.conf import settings
+from apps.host.models import Host
+from threading import Event
+import hashlib
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# 按 fan-out 树分发构建包：Spug 只上传给前几台种子主机，其余主机从其父节点中继拉取
+# 中继主机上的构建包即该主机自身发布使用的构建包，与其他主机一样保留，供重试或重复发布时校验后跳过传输
+class Distributor:
+    def __init__(self, local_file, host_ids, fanout):
+        self.local_file = local_file
+        self.fanout = fanout
+        self.checksum = file_sha256(local_file)
+        self.index = {h_id: i + 1 for i, h_id in enumerate(host_ids)}
+        self.host_ids = list(host_ids)
+        self.events = {h_id: Event() for h_id in host_ids}
+        self.sources = {}
+
+    @classmethod
+    def make(cls, req, local_file):
+        # 中继树的顺序须与主机的发布顺序一致（按主机ID升序），串行发布时父节点总是先于子节点完成传输
+        fanout = settings.DEPLOY_FANOUT
+        if fanout and req.type != '2' and len(req.host_ids) > fanout:
+            return cls(local_file, sorted(req.host_ids), fanout)
+        return None
+
+    def get_parent_id(self, h_id):
+        parent_index = (self.index[h_id] - 1) // self.fanout
+        return self.host_ids[parent_index - 1] if parent_index else None
+
+    def release(self, h_id, path=None):
+        if not self.events[h_id].is_set():
+            self.sources[h_id] = path
+            self.events[h_id].set()
+
+    def transfer(self, helper, host, ssh, dst_file):
+        parent_id = self.get_parent_id(host.id)
+        if parent_id:
+            self.events[parent_id].wait()
+            if self.sources.get(parent_id):
+                parent = Host.objects.filter(pk=parent_id).first()
+                helper.send_info(host.id, f'\r\n从主机 {parent.name} 中继传输...        ')
+                try:
+                    self._relay(parent, self.sources[parent_id], host, dst_file)
+                    self._verify(ssh, dst_file)
+                    self.release(host.id, dst_file)
+                    return
+                except Exception as e:
+                    helper.send_info(host.id, f'\033[33m中继失败：{e}，改为直接上传\033[0m')
+
+        try:
+            callback = helper.progress_callback(host.id)
+            ssh.put_file(self.local_file, dst_file, callback)
+            self._verify(ssh, dst_file)
+        except Exception as e:
+            self.release(host.id)
+            helper.send_error(host.id, f'Exception: {e}')
+        self.release(host.id, dst_file)
+
+    def _relay(self, parent, src_file, host, dst_file):
+        # 父节点通过转发的 agent 认证子节点，私钥始终只在 Spug 进程内，agent 随本次命令结束失效
+        options = '-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o BatchMode=yes'
+        command = f'scp -q {options} -P {host.port} {src_file} {host.username}@{host.hostname}:{dst_file}'
+        with parent.get_ssh(pooled=False) as ssh:
+            code, out = ssh.exec_command_with_agent(command, host.private_key)
+        if code != 0:
+            raise RuntimeError(out.strip() or f'exit code: {code}')
+
+    def _verify(self, ssh, dst_file):
+        code, out = ssh.exec_command_raw(f'sha256sum {dst_file}')
+        if code != 0 or out.split()[:1] != [self.checksum]:
+            raise RuntimeError(f'checksum mismatch for {dst_file}')
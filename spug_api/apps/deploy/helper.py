@@ -1,13 +1,19 @@
 # Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
 # Copyright: (c) <spug.dev@gmail.com>
 # Released under the AGPL-3.0 License.
+from django.conf import settings
 from django.template.defaultfilters import filesizeformat
-from libs.utils import human_datetime, render_str, str_decode
+from libs.utils import human_datetime, render_str
 from libs.spug import Notification
+from libs.ssh import StreamDecoder
+from libs.metrics import DEPLOY_STEP_SECONDS
+from libs import logstore
 from apps.host.models import Host
 from functools import partial
+from threading import Lock, Timer
 import subprocess
 import json
+import time
 import os
 
 
@@ -16,28 +22,27 @@ class SpugError(Exception):
 
 
 class Helper:
+    # 日志先写入缓冲区，累计超过 16KB 或 100ms 后批量写入 Redis
+    flush_size = 16 * 1024
+    flush_interval = 0.1
+
     def __init__(self, rds, key):
         self.rds = rds
         self.key = key
         self.callback = []
+        self.buffer = []
+        self.buffer_size = 0
+        self.lock = Lock()
+        self.timer = None
+        self.steps = {}
+        self.seq = logstore.get_seq(rds, key)
 
     @classmethod
     def make(cls, rds, key, host_ids=None):
         if host_ids:
-            counter, tmp_key = 0, f'{key}_tmp'
-            data = rds.lrange(key, counter, counter + 9)
-            while data:
-                for item in data:
-                    counter += 1
-                    tmp = json.loads(item.decode())
-                    if tmp['key'] not in host_ids:
-                        rds.rpush(tmp_key, item)
-                data = rds.lrange(key, counter, counter + 9)
-            rds.delete(key)
-            if rds.exists(tmp_key):
-                rds.rename(tmp_key, key)
+            logstore.remove(rds, key, host_ids)
         else:
-            rds.delete(key)
+            logstore.delete(rds, key)
         return cls(rds, key)
 
     @classmethod
@@ -236,7 +241,31 @@ class Helper:
         return files
 
     def _send(self, message):
-        self.rds.rpush(self.key, json.dumps(message))
+        with self.lock:
+            last = self.buffer[-1] if self.buffer else None
+            if last and last.keys() == message.keys() == {'key', 'data'} and last['key'] == message['key']:
+                last['data'] += message['data']
+            else:
+                self.buffer.append(message)
+            self.buffer_size += len(message.get('data') or '')
+            if self.buffer_size >= self.flush_size:
+                self._flush()
+            elif self.timer is None:
+                self.timer = Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.buffer:
+            self.seq = logstore.append(self.rds, self.key, self.buffer, self.seq)
+            self.buffer, self.buffer_size = [], 0
+
+    def flush(self):
+        with self.lock:
+            self._flush()
 
     def send_info(self, key, message):
         if message:
@@ -249,12 +278,25 @@ class Helper:
             raise SpugError
 
     def send_step(self, key, step, data):
+        self._observe_step(key, step)
         self._send({'key': key, 'step': step, 'data': data})
 
+    def _observe_step(self, key, step):
+        # 步骤切换时记录上一步骤的耗时
+        now, last = time.time(), self.steps.get(key)
+        if last and last[0] == step:
+            return
+        if last:
+            target = key if key in ('local', 'image') else 'host'
+            DEPLOY_STEP_SECONDS.labels(self.key.rsplit(':', 1)[0], target, last[0]).observe(now - last[1])
+        self.steps[key] = (step, now)
+
     def clear(self):
-        self.rds.delete(f'{self.key}_tmp')
-        # save logs for two weeks
-        self.rds.expire(self.key, 14 * 24 * 60 * 60)
+        self.flush()
+        try:
+            logstore.archive(self.rds, self.key)
+        except Exception:
+            logstore.expire(self.rds, self.key, settings.LOG_EXPIRE)
         self.rds.close()
         # callback
         for func in self.callback:
@@ -273,18 +315,13 @@ class Helper:
             env = dict(env.items())
             env.update(os.environ)
         task = subprocess.Popen(command, env=env, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        message = b''
+        decoder = StreamDecoder()
         while True:
-            output = task.stdout.read(1)
+            output = task.stdout.read1(64 * 1024)
+            message = decoder.decode(output, not output)
+            self.send_info('local', message.replace('\n', '\r\n'))
             if not output:
                 break
-            if output in (b'\r', b'\n'):
-                message += b'\r\n' if output == b'\n' else b'\r'
-                message = str_decode(message)
-                self.send_info('local', message)
-                message = b''
-            else:
-                message += output
         if task.wait() != 0:
             self.send_error('local', f'exit code: {task.returncode}')
 
@@ -4,6 +4,7 @@
 from django.db import models
 from django.conf import settings
 from libs import ModelMixin, human_datetime
+from libs.logstore import delete_archive
 from apps.account.models import User
 from apps.app.models import Deploy
 from apps.repository.models import Repository
@@ -66,6 +67,7 @@ class DeployRequest(models.Model, ModelMixin):
         super().save(*args, **kwargs)
 
     def delete(self, using=None, keep_parents=False):
+        delete_archive(f'{settings.REQUEST_KEY}:{self.id}')
         super().delete(using, keep_parents)
         if self.repository_id:
             if not DeployRequest.objects.filter(repository=self.repository).exists():
@@ -0,0 +1,43 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.test import SimpleTestCase, override_settings
+from unittest import mock
+from threading import Thread
+from libs.utils import AttrDict
+from apps.deploy import utils
+
+
+@override_settings(DEPLOY_FANOUT=1, DEPLOY_DELTA=False)
+class SerialRelayTest(SimpleTestCase):
+    def test_unsorted_host_ids(self):
+        # 串行发布按主机ID升序执行，每台主机的中继父节点必须已完成传输，否则会一直等待
+        req = AttrDict(
+            repository_id=1,
+            extra='["branch", "master", "abc"]',
+            spug_version='1_1_20220101',
+            type='1',
+            host_ids=[5, 3, 9, 1],
+            fail_host_ids=[5, 3, 9, 1],
+            deploy=AttrDict(is_parallel=False),
+        )
+        order = []
+
+        def deploy_host(req, helper, h_id, env):
+            req.distributor.transfer(helper, AttrDict(id=h_id), mock.Mock(), f'/tmp/{h_id}.tar.gz')
+            order.append(h_id)
+
+        with mock.patch.object(utils, 'file_sha256', return_value='0' * 64), \
+                mock.patch.object(utils, '_deploy_ext1_host', deploy_host), \
+                mock.patch('apps.deploy.distribute.file_sha256', return_value='0' * 64), \
+                mock.patch('apps.deploy.distribute.Host') as host, \
+                mock.patch('apps.deploy.distribute.Distributor._relay'), \
+                mock.patch('apps.deploy.distribute.Distributor._verify'):
+            host.objects.filter.return_value.first.return_value = AttrDict(name='relay')
+            t = Thread(target=utils._ext1_deploy, args=(req, mock.Mock(), AttrDict()), daemon=True)
+            t.start()
+            t.join(5)
+
+        self.assertFalse(t.is_alive())
+        self.assertEqual(order, [1, 3, 5, 9])
+        self.assertEqual(req.fail_host_ids, [])
@@ -13,6 +13,9 @@ from apps.repository.models import Repository
 from apps.repository.utils import dispatch as build_repository
 from apps.deploy.models import DeployRequest
 from apps.deploy.helper import Helper, SpugError
+from apps.deploy.distribute import Distributor, file_sha256
+from apps.deploy.delta import DeltaPacker, find_prev_version
+from django.template.defaultfilters import filesizeformat
 from apps.docker_image.models import DockerImage
 from apps.docker_image.utils import dispatch as build_docker_image
 from concurrent import futures
@@ -104,14 +107,26 @@ def _ext1_deploy(req, helper, env):
         env.update(SPUG_GIT_BRANCH=extras[1], SPUG_GIT_COMMIT_ID=extras[2])
     else:
         env.update(SPUG_GIT_TAG=extras[1])
+    tar_file = os.path.join(BUILD_DIR, f'{req.spug_version}.tar.gz')
+    req.distributor = Distributor.make(req, tar_file)
+    if req.distributor:
+        req.checksum = req.distributor.checksum
+    elif req.type != '2':
+        req.checksum = file_sha256(tar_file)
+    req.delta = None
+    if settings.DEPLOY_DELTA and req.type != '2':
+        req.delta = DeltaPacker(tar_file, REPOS_DIR)
+        helper.add_callback(req.delta.cleanup)
     if req.deploy.is_parallel:
         threads, latest_exception = [], None
         max_workers = max(10, os.cpu_count() * 5)
         with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            for h_id in req.host_ids:
+            for h_id in sorted(req.host_ids):
                 new_env = AttrDict(env.items())
                 t = executor.submit(_deploy_ext1_host, req, helper, h_id, new_env)
                 t.h_id = h_id
+                if req.distributor:
+                    t.add_done_callback(lambda _, x=h_id: req.distributor.release(x))
                 threads.append(t)
             for t in futures.as_completed(threads):
                 exception = t.exception()
@@ -136,6 +151,9 @@ def _ext1_deploy(req, helper, env):
                 for h_id in host_ids:
                     helper.send_error(h_id, '终止发布', False)
                 raise e
+            finally:
+                if req.distributor:
+                    req.distributor.release(h_id)
 
 
 def _ext2_deploy(req, helper, env):
@@ -377,22 +395,38 @@ def _deploy_ext1_host(req, helper, h_id, env):
             helper.send_step(h_id, 1, '\033[33m跳过√\033[0m\r\n')
         else:
             # clean
-            clean_command = f'ls -d {extend.deploy_id}_* 2> /dev/null | sort -t _ -rnk2 | tail -n +{extend.versions + 1} | xargs rm -rf'
+            clean_command = f'ls -d {extend.deploy_id}_*/ 2> /dev/null | sort -t _ -rnk2 | tail -n +{extend.versions + 1} | xargs rm -rf'
             helper.remote_raw(host.id, ssh, f'cd {extend.dst_repo} && {clean_command}')
             # transfer files
             tar_gz_file = f'{req.spug_version}.tar.gz'
-            try:
-                callback = helper.progress_callback(host.id)
-                ssh.put_file(
-                    os.path.join(BUILD_DIR, tar_gz_file),
-                    os.path.join(extend.dst_repo, tar_gz_file),
-                    callback
-                )
-            except Exception as e:
-                helper.send_error(host.id, f'Exception: {e}')
+            dst_file = os.path.join(extend.dst_repo, tar_gz_file)
+            extracted = False
+            if _probe_artifact(ssh, extend.dst_repo, tar_gz_file, req.checksum):
+                size = filesizeformat(os.path.getsize(os.path.join(BUILD_DIR, tar_gz_file)))
+                helper.send_info(host.id, f'\033[33m主机已存在该版本，跳过传输（节省 {size}）\033[0m  ')
+                if req.distributor:
+                    req.distributor.release(h_id, dst_file)
+            elif req.delta and _delta_transfer(req, helper, host, ssh, extend):
+                extracted = True
+                if req.distributor:
+                    req.distributor.release(h_id)
+            elif req.distributor:
+                req.distributor.transfer(helper, host, ssh, dst_file)
+            else:
+                try:
+                    callback = helper.progress_callback(host.id)
+                    ssh.put_file(os.path.join(BUILD_DIR, tar_gz_file), dst_file, callback)
+                except Exception as e:
+                    helper.send_error(host.id, f'Exception: {e}')
 
-            command = f'cd {extend.dst_repo} && rm -rf {req.spug_version} && tar xf {tar_gz_file} && rm -f {req.deploy_id}_*.tar.gz'
-            helper.remote_raw(host.id, ssh, command)
+            if not extracted:
+                # 每次都解压到全新的版本目录，保证重试时发布前任务不会运行在上次修改过的目录上
+                # 保留本次的构建包及其校验文件，重试时可跳过传输，同时供中继节点的下游主机拉取
+                command = f'cd {extend.dst_repo} && rm -rf {req.spug_version} && mkdir {req.spug_version} && '
+                command += f'tar xf {tar_gz_file} -C {req.spug_version} --strip-components=1 && '
+                command += f'echo {req.checksum} > {tar_gz_file}.sha256 && '
+                command += f'ls {req.deploy_id}_*.tar.gz* | grep -vx -e {tar_gz_file} -e {tar_gz_file}.sha256 | xargs rm -f'
+                helper.remote_raw(host.id, ssh, command)
             helper.send_step(h_id, 1, '\033[32m完成√\033[0m\r\n')
 
         # pre host
@@ -416,6 +450,29 @@ def _deploy_ext1_host(req, helper, h_id, env):
         helper.send_step(h_id, 100, f'\r\n{human_time()} ** \033[32m发布成功\033[0m **')
 
 
+def _probe_artifact(ssh, dst_repo, tar_gz_file, checksum):
+    # 重试或重复发布时，主机上已有完整的构建包（解压成功后写入 {tar_gz_file}.sha256）则跳过传输
+    # 否则先删除校验文件，避免传输中断后残缺的构建包被误判为完整
+    command = f'cd {dst_repo} && if [ -f {tar_gz_file} ] && [ "$(cat {tar_gz_file}.sha256 2> /dev/null)" = "{checksum}" ]; '
+    command += f'then echo ok; else rm -f {tar_gz_file}.sha256; fi'
+    code, out = ssh.exec_command_raw(command)
+    return code == 0 and out.strip() == 'ok'
+
+
+def _delta_transfer(req, helper, host, ssh, extend):
+    prev_version = find_prev_version(ssh, extend.dst_dir, extend.dst_repo, req.deploy_id, req.spug_version)
+    if not prev_version:
+        return False
+    try:
+        size = req.delta.transfer(helper, host, ssh, extend.dst_repo, prev_version, req.spug_version)
+    except Exception as e:
+        helper.send_info(host.id, f'\r\n\033[33m增量传输失败：{e}，改为完整传输\033[0m')
+        return False
+    total = os.path.getsize(os.path.join(BUILD_DIR, f'{req.spug_version}.tar.gz'))
+    helper.send_info(host.id, f'\033[33m（节省 {filesizeformat(max(total - size, 0))}）\033[0m  ')
+    return True
+
+
 def _deploy_ext2_host(helper, h_id, actions, env, spug_version):
     helper.send_info(h_id, '\033[32m就绪√\033[0m\r\n')
     host = Host.objects.filter(pk=h_id).first()
@@ -7,6 +7,7 @@ from django.conf import settings
 from django.http.response import HttpResponseBadRequest
 from django_redis import get_redis_connection
 from libs import json_response, JsonParser, Argument, human_datetime, human_time, auth
+from libs import logstore
 from apps.deploy.models import DeployRequest
 from apps.app.models import Deploy, DeployExtend2
 from apps.repository.models import Repository
@@ -132,6 +133,13 @@ class RequestView(View):
 class RequestDetailView(View):
     @auth('deploy.request.view')
     def get(self, request, r_id):
+        form, error = JsonParser(
+            Argument('host_id', required=False),
+            Argument('summary', type=bool, default=False, required=False),
+            Argument('index', type=int, default=0, required=False),
+        ).parse(request.GET)
+        if error is not None:
+            return json_response(error=error)
         req = DeployRequest.objects.filter(pk=r_id).first()
         if not req:
             return json_response(error='未找到指定发布申请')
@@ -147,39 +155,41 @@ class RequestDetailView(View):
             response['s_actions'] = json.loads(req.deploy.extend_obj.server_actions)
             response['h_actions'] = json.loads(req.deploy.extend_obj.host_actions)
             if not response['h_actions']:
-                response['outputs'] = {'local': outputs['local']}
+                response['outputs'] = outputs = {'local': outputs['local']}
         if req.deploy.extend == '3':
             outputs['local'] = {'id': 'local', 'data': '', 'title': '代码构建'}
             outputs['image'] = {'id': 'image', 'data': '', 'title': '镜像编译'}
-        rds, key, counter = get_redis_connection(), f'{settings.REQUEST_KEY}:{r_id}', 0
-        data = rds.lrange(key, counter, counter + 9)
-        while data:
-            for item in data:
-                counter += 1
-                item = json.loads(item.decode())
-                if item['key'] in outputs:
-                    if 'data' in item:
-                        outputs[item['key']]['data'] += item['data']
-                    if 'step' in item:
-                        outputs[item['key']]['step'] = item['step']
-                    if 'status' in item:
-                        outputs[item['key']]['status'] = item['status']
-            data = rds.lrange(key, counter, counter + 9)
-        response['index'] = counter
-        if counter == 0:
+        if form.host_id:
+            response['outputs'] = outputs = {k: v for k, v in outputs.items() if str(k) == form.host_id}
+
+        # 日志按主机分片存储，步骤概要来自索引，指定主机时仅读取该主机的日志，指定 index 时仅读取其后的日志
+        rds, key = get_redis_connection(), f'{settings.REQUEST_KEY}:{r_id}'
+        seq, summary = logstore.get_summary(rds, key)
+        for k, item in outputs.items():
+            item.update((x, y) for x, y in summary.get(str(k), {}).items() if x != 'seq')
+        if not form.summary:
+            keys = list(outputs) if form.host_id else None
+            for _, item in logstore.iter_logs(rds, key, keys, seq, form.index + 1):
+                if item['key'] in outputs and 'data' in item:
+                    outputs[item['key']]['data'] += item['data']
+        response['index'] = seq
+        if seq == 0:
             for item in outputs:
-                outputs[item]['data'] += '\r\n\r\n未读取到数据，Spug 仅保存最近2周的日志信息。'
+                outputs[item]['data'] += f'\r\n\r\n未读取到数据，日志已被删除或未能归档（未归档的日志仅保存最近{settings.LOG_EXPIRE // 86400}天）。'
 
-        if req.is_quick_deploy:
-            if outputs['local']['data']:
+        if req.is_quick_deploy and 'local' in outputs:
+            if 'local' in summary:
                 outputs['local']['data'] = f'{human_time()} 读取数据...        ' + outputs['local']['data']
             else:
                 outputs['local'].update(step=100, data=f'{human_time()} 已构建完成忽略执行。')
                 
         if req.type == '0':
-            del outputs['local']
-            del outputs['image']
-            
+            outputs.pop('local', None)
+            outputs.pop('image', None)
+
+        if form.summary:
+            for item in outputs.values():
+                item.pop('data', None)
         return json_response(response)
 
     @auth('deploy.request.do')
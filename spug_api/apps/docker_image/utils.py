@@ -188,7 +188,7 @@ def _build(rep: DockerImage, helper, env, image_url):
         except Exception as e:
             helper.send_error('image', f'Exception: {e}')
             
-        command = f'cd {extend.dst_repo} && rm -rf {rep.spug_version} && tar xf {tar_gz_file} && rm -f {rep.deploy_id}_*.tar.gz'
+        command = f'cd {extend.dst_repo} && rm -rf {rep.spug_version} && mkdir {rep.spug_version} && tar xf {tar_gz_file} -C {rep.spug_version} --strip-components=1 && rm -f {rep.deploy_id}_*.tar.gz'
         helper.remote_raw('image', ssh, command)
         helper.send_step('image', 1, '\033[32m完成√\033[0m\r\n')
         
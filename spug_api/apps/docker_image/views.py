@@ -6,6 +6,7 @@ from django.db.models import F
 from django.conf import settings
 from django_redis import get_redis_connection
 from libs import json_response, JsonParser, Argument, human_time, AttrDict, auth
+from libs import logstore
 from apps.docker_image.models import DockerImage
 from apps.deploy.models import DeployRequest
 from apps.docker_image.utils import dispatch
@@ -159,7 +160,7 @@ def get_detail(request, r_id):
     docker_image = DockerImage.objects.filter(pk=r_id).first()
     if not docker_image:
         return json_response(error='未找到指定构建记录')
-    rds, counter = get_redis_connection(), 0
+    rds = get_redis_connection()
     if docker_image.remarks == 'SPUG AUTO MAKE':
         req = docker_image.deployrequest_set.filter(docker_image_id=docker_image.id, spug_version=docker_image.spug_version).last()
         if req is not None:
@@ -174,21 +175,14 @@ def get_detail(request, r_id):
     outputs['local'] = {'id': 'local', 'data': '', 'title': '代码构建'}
     outputs['image'] = {'id': 'image', 'data': '', 'title': '镜像编译'}
     response = AttrDict(data='', outputs= outputs, step=0, s_status='process', status=docker_image.status)
-    data = rds.lrange(key, counter, counter + 9)
-    while data:
-        for item in data:
-            counter += 1
-            item = json.loads(item.decode())
-            if item['key'] in outputs:
-                if 'data' in item:
-                    outputs[item['key']]['data'] += item['data']
-                if 'step' in item:
-                    outputs[item['key']]['step'] = item['step']
-                if 'status' in item:
-                    outputs[item['key']]['status'] = item['status']
-        data = rds.lrange(key, counter, counter + 9)
-    response['index'] = counter
-    if counter == 0:
+    seq, summary = logstore.get_summary(rds, key)
+    for k, item in outputs.items():
+        item.update((x, y) for x, y in summary.get(k, {}).items() if x != 'seq')
+    for _, item in logstore.iter_logs(rds, key, list(outputs), seq):
+        if 'data' in item:
+            outputs[item['key']]['data'] += item['data']
+    response['index'] = seq
+    if seq == 0:
         for item in outputs:
-            outputs[item]['data'] += '\r\n\r\n未读取到数据，Spug 仅保存最近2周的日志信息。'
+            outputs[item]['data'] += f'\r\n\r\n未读取到数据，日志已被删除或未能归档（未归档的日志仅保存最近{settings.LOG_EXPIRE // 86400}天）。'
     return json_response(response)
@@ -0,0 +1,105 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.conf import settings
+from libs.utils import human_seconds_time
+from libs.ssh import StreamParser
+from libs.aio import submit
+from apps.exec.executors import Job
+from uuid import uuid4
+import aioredis
+import asyncio
+import logging
+import json
+import time
+
+_context = {}
+
+
+async def _get_context():
+    if not _context:
+        _context['semaphore'] = asyncio.Semaphore(settings.EXEC_ASYNC_CONCURRENCY)
+        _context['redis'] = await aioredis.create_redis_pool(settings.CACHES['default']['LOCATION'])
+    return _context
+
+
+def _log_exception(future):
+    exception = future.exception()
+    if exception:
+        logging.warning(f'async exec job error: {exception!r}')
+
+
+# 基于 asyncssh 的批量执行，单个事件循环即可承载大量并发会话，消息格式与 Job 保持一致
+class AsyncJob(Job):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rds = None
+
+    async def _send(self, message):
+        await self.rds.publish(self.token, json.dumps(message))
+
+    async def send(self, data):
+        await self._send({'key': self.key, 'data': data})
+
+    async def send_status(self, code):
+        await self._send({'key': self.key, 'status': code})
+
+    def run(self):
+        future = submit(self.run_async())
+        future.add_done_callback(_log_exception)
+        return future
+
+    async def run_async(self):
+        context = await _get_context()
+        self.rds = context['redis']
+        async with context['semaphore']:
+            flag = time.time()
+            await self.send('\r\n\x1b[36m### Executing ...\x1b[0m\r\n')
+            code = -1
+            try:
+                code = await asyncio.wait_for(self._execute(), settings.EXEC_ASYNC_TIMEOUT)
+                human_time = human_seconds_time(time.time() - flag)
+                await self.send(f'\r\n\x1b[36m** 执行结束，总耗时：{human_time} **\x1b[0m')
+            except asyncio.TimeoutError:
+                code = 130
+                await self.send('\r\n\x1b[31m### Time out\x1b[0m')
+            except Exception as e:
+                code = 131
+                await self.send(f'\r\n\x1b[31m### Exception {e}\x1b[0m')
+                raise e
+            finally:
+                await self.send_status(code)
+
+    async def _execute(self):
+        term = self.ssh.term
+        async with await self.ssh.connect_async() as conn:
+            process = await conn.create_process(
+                term_type=term.get('term', 'vt100'),
+                term_size=(term.get('width', 80), term.get('height', 24)),
+                encoding=None
+            )
+            await self._exec_command(conn, process, self.ssh.init_command)
+            code = await self._exec_command(conn, process, self.command, self.env, True)
+            process.close()
+            return code
+
+    async def _exec_command(self, conn, process, command, environment=None, with_stream=False):
+        script = self.ssh._make_script(command, environment)
+        line = self.ssh._make_inline_command(script)
+        if not line:
+            exec_file = f'/tmp/spug.{uuid4().hex}'
+            async with conn.start_sftp_client() as sftp:
+                async with sftp.open(exec_file, 'w') as f:
+                    await f.write(script)
+            line = f'trap \'rm -f {exec_file}\' EXIT\n. {exec_file}\n'
+        process.stdin.write(line.encode())
+
+        parser = StreamParser(self.ssh.eof)
+        while not parser.is_done:
+            data = await process.stdout.read(8196)
+            out = parser.feed(data) if data else parser.finish()
+            if out and with_stream:
+                await self.send(out)
+            if not data:
+                break
+        return parser.exit_code
@@ -2,23 +2,36 @@
 # Copyright: (c) <spug.dev@gmail.com>
 # Released under the AGPL-3.0 License.
 from django_redis import get_redis_connection
+from django.conf import settings
 from libs.utils import human_seconds_time
 from libs.ssh import SSH
-import threading
 import socket
 import json
 import time
 
 
 def exec_worker_handler(job):
-    job = Job(**json.loads(job))
-    threading.Thread(target=job.run).start()
+    if settings.EXEC_WORKER_ENGINE == 'asyncio':
+        from apps.exec.aio import AsyncJob
+        return AsyncJob(**json.loads(job)).run()
+    else:
+        Job(**json.loads(job)).run()
+
+
+def exec_worker_abort(job):
+    # worker 崩溃时任务可能已在主机上执行，认领后不重新执行，仅通知前端执行失败
+    job = json.loads(job)
+    if job.get('token'):
+        rds = get_redis_connection()
+        message = '\r\n\x1b[31m### 执行中断：worker 异常退出，为避免重复执行未重试，请检查主机上的执行结果\x1b[0m'
+        rds.publish(job['token'], json.dumps({'key': job['key'], 'data': message}))
+        rds.publish(job['token'], json.dumps({'key': job['key'], 'status': 132}))
 
 
 class Job:
     def __init__(self, key, name, hostname, port, username, pkey, command, interpreter, params=None, token=None,
-                 term=None):
-        self.ssh = SSH(hostname, port, username, pkey, term=term)
+                 term=None, user_id=None):
+        self.ssh = SSH(hostname, port, username, pkey, term=term, pooled=True)
         self.key = key
         self.command = self._handle_command(command, interpreter)
         self.token = token
@@ -5,39 +5,206 @@ from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.db import connections
 from django_redis import get_redis_connection
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future
 from apps.schedule.executors import schedule_worker_handler
 from apps.monitor.executors import monitor_worker_handler
-from apps.exec.executors import exec_worker_handler
+from apps.exec.executors import exec_worker_handler, exec_worker_abort
 from apps.notify.models import Notify
-from threading import Thread
+from libs import jobqueue, metrics
+from prometheus_client import Gauge
+from collections import OrderedDict, defaultdict, deque
+from functools import partial
+from threading import Thread, Lock, Event
 import logging
 import time
-import os
+import json
 
 EXEC_WORKER_KEY = settings.EXEC_WORKER_KEY
 MONITOR_WORKER_KEY = settings.MONITOR_WORKER_KEY
 SCHEDULE_WORKER_KEY = settings.SCHEDULE_WORKER_KEY
+KEEPALIVE_TTL = 60
+POOL_RUNNING = Gauge('spug_worker_pool_running', 'runworker 进程中执行中的任务数', ['queue'])
+POOL_WAITING = Gauge('spug_worker_pool_waiting', 'runworker 进程中已接收待执行的任务数', ['queue'])
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
 
 
+# 每类队列使用独立的有界线程池，避免大量监控任务饿死交互式的批量执行
+# 同一类队列内按用户轮转调度，quota 限制单个用户同时运行的任务数（0 表示不限制）
+# 本地最多接收 concurrency + prefetch 个任务，超出部分留在 Redis 中排队，worker 崩溃时也不会丢失
+# 异步执行引擎的 handler 提交至事件循环后立即返回 Future，此时即释放线程池的并发槽位，由事件循环的信号量限制并发，
+# 事件循环中最多 detached_limit 个任务，用户配额在任务实际结束后才释放
+class JobPool:
+    def __init__(self, name, handler, concurrency, prefetch, quota=0, released=None, detached_limit=0):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        self.quota = quota
+        self.detached_limit = detached_limit
+        self.running = 0
+        self.detached = 0
+        self.user_running = defaultdict(int)
+        self.waiting = OrderedDict()
+        self.stats = {'jobs': 0, 'wait_seconds': 0.0, 'exec_seconds': 0.0}
+        self.lock = Lock()
+        self.released = released or Event()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        POOL_RUNNING.labels(name).set_function(lambda: self.running + self.detached)
+        POOL_WAITING.labels(name).set_function(lambda: self.qsize)
+
+    @property
+    def qsize(self):
+        with self.lock:
+            return sum(len(x) for x in self.waiting.values())
+
+    @property
+    def capacity(self):
+        return self.concurrency + self.prefetch + self.detached_limit - self.running - self.detached - self.qsize
+
+    def get_stats(self):
+        with self.lock:
+            running = self.running + self.detached
+            return dict(self.stats, running=running, waiting=sum(len(x) for x in self.waiting.values()))
+
+    def submit(self, job, callback, user=None, created=None):
+        task = {'job': job, 'callback': callback, 'user': user, 'created': created or time.time()}
+        with self.lock:
+            self.waiting.setdefault(user, deque()).append(task)
+            tasks = self._schedule()
+        self._start(tasks)
+
+    def _schedule(self):
+        tasks = []
+        while self.running < self.concurrency:
+            for user, queue in self.waiting.items():
+                if not self.quota or self.user_running.get(user, 0) < self.quota:
+                    break
+            else:
+                break
+            task = queue.popleft()
+            if queue:
+                self.waiting.move_to_end(user)
+            else:
+                self.waiting.pop(user)
+            self.running += 1
+            self.user_running[user] += 1
+            tasks.append(task)
+        return tasks
+
+    def _start(self, tasks):
+        for task in tasks:
+            future = self._executor.submit(self._run, task)
+            future.add_done_callback(partial(self._done, task))
+
+    def _run(self, task):
+        task['started'] = time.time()
+        return self.handler(task['job'])
+
+    def _done(self, task, future):
+        # 异步执行引擎的 handler 会立即返回 Future，先释放并发槽位，待其完成后再释放配额
+        result = None if future.cancelled() or future.exception() else future.result()
+        if isinstance(result, Future):
+            with self.lock:
+                self.running -= 1
+                self.detached += 1
+                tasks = self._schedule()
+            self._start(tasks)
+            self.released.set()
+            result.add_done_callback(partial(self._release, task, detached=True))
+        else:
+            self._release(task, future)
+
+    def _release(self, task, future, detached=False):
+        user, now = task['user'], time.time()
+        with self.lock:
+            if detached:
+                self.detached -= 1
+            else:
+                self.running -= 1
+            self.user_running[user] -= 1
+            if self.user_running[user] <= 0:
+                self.user_running.pop(user)
+            self.stats['jobs'] += 1
+            if 'started' in task:
+                wait_seconds, exec_seconds = max(0.0, task['started'] - task['created']), now - task['started']
+                self.stats['wait_seconds'] += wait_seconds
+                self.stats['exec_seconds'] += exec_seconds
+                metrics.JOB_WAIT_SECONDS.labels(self.name).observe(wait_seconds)
+                metrics.JOB_EXEC_SECONDS.labels(self.name).observe(exec_seconds)
+            tasks = self._schedule()
+        self._start(tasks)
+        self.released.set()
+        task['callback'](future)
+
+
 class Worker:
     def __init__(self):
         self.rds = get_redis_connection()
-        self._executor = ThreadPoolExecutor(max_workers=max(100, os.cpu_count() * 50))
+        self.consumer = jobqueue.get_consumer_name()
+        self.released = Event()
+        detached_limit = settings.EXEC_ASYNC_CONCURRENCY if settings.EXEC_WORKER_ENGINE == 'asyncio' else 0
+        self.pools = {
+            EXEC_WORKER_KEY: self._make_pool('exec', exec_worker_handler, settings.EXEC_USER_QUOTA, detached_limit),
+            SCHEDULE_WORKER_KEY: self._make_pool('schedule', schedule_worker_handler),
+            MONITOR_WORKER_KEY: self._make_pool('monitor', monitor_worker_handler),
+        }
 
-    def job_done(self, future):
+    def _make_pool(self, name, handler, quota=0, detached_limit=0):
+        concurrency, prefetch = settings.WORKER_CONCURRENCY[name], settings.WORKER_PREFETCH[name]
+        return JobPool(name, handler, concurrency, prefetch, quota, self.released, detached_limit)
+
+    def job_done(self, key, entry_id, future):
+        try:
+            jobqueue.ack(self.rds, key, entry_id)
+        except Exception as e:
+            logging.warning(f'ack {key} {entry_id} failed: {e}')
         connections.close_all()
 
+    def dispatch(self, key, entry_id, job):
+        user = json.loads(job).get('user_id') if key == EXEC_WORKER_KEY else None
+        # 任务的入队时间取自 Stream entry ID 中的毫秒时间戳
+        created = int(entry_id.split(b'-')[0]) / 1000
+        self.pools[key].submit(job, partial(self.job_done, key, entry_id), user, created)
+
+    def get_stats(self):
+        return {key: pool.get_stats() for key, pool in self.pools.items()}
+
+    def keepalive(self):
+        # 刷新存活标记，并认领已崩溃 worker 未完成的任务，批量执行的任务不重新执行，仅标记为失败
+        # 重新执行的任务与 XREADGROUP 读取的一样仅认领队列余量内的数量，并经由线程池按用户配额调度
+        while True:
+            try:
+                jobqueue.keepalive(self.rds, self.consumer, KEEPALIVE_TTL, self.get_stats())
+                for key, pool in self.pools.items():
+                    count = 100 if key == EXEC_WORKER_KEY else min(pool.capacity, 100)
+                    if count <= 0:
+                        continue
+                    for _, entry_id, job in jobqueue.claim(self.rds, key, self.consumer, count):
+                        if key == EXEC_WORKER_KEY:
+                            logging.warning(f'abort reclaimed job {key} {entry_id}')
+                            exec_worker_abort(job)
+                            jobqueue.ack(self.rds, key, entry_id)
+                        else:
+                            logging.warning(f'reclaim job {key} {entry_id}')
+                            self.dispatch(key, entry_id, job)
+            except Exception as e:
+                logging.warning(f'keepalive failed: {e}')
+            time.sleep(KEEPALIVE_TTL / 3)
+
     def queue_monitor(self):
         counter = 0
         while True:
             time.sleep((counter or 1) ** 3 * 10)
-            qsize = self._executor._work_queue.qsize()
+            try:
+                qsize = sum(x['depth'] for x in jobqueue.get_stats(self.rds, self.pools).values())
+            except Exception as e:
+                logging.warning(f'get queue stats failed: {e}')
+                continue
             if qsize > 0:
-                if counter > 0:
-                    content = '请检查监控、任务计划或批量执行等避免长耗时任务，必要时可重启服务清空队列。'
+                # 多个 worker 同时检测到堆积时仅通知一次
+                if counter > 0 and self.rds.set(f'{settings.WORKER_GROUP}:notify', 1, nx=True, ex=60):
+                    content = '请检查监控、任务计划或批量执行等避免长耗时任务，必要时可增加 runworker 进程分担负载。'
                     try:
                         Notify.make_system_notify(f'执行队列堆积（{qsize}）', content)
                     except Exception as e:
@@ -50,26 +217,35 @@ class Worker:
                 counter = 0
 
     def run(self):
-        logging.warning('Running worker')
+        logging.warning(f'Running worker {self.consumer}')
+        for key in self.pools:
+            jobqueue.create_group(self.rds, key)
+        jobqueue.keepalive(self.rds, self.consumer, KEEPALIVE_TTL, self.get_stats())
         Thread(target=self.queue_monitor, daemon=True).start()
-        self.rds.delete(EXEC_WORKER_KEY, MONITOR_WORKER_KEY, SCHEDULE_WORKER_KEY)
+        Thread(target=self.keepalive, daemon=True).start()
         while True:
-            key, job = self.rds.blpop([EXEC_WORKER_KEY, SCHEDULE_WORKER_KEY, MONITOR_WORKER_KEY])
-            key = key.decode()
-            if key == SCHEDULE_WORKER_KEY:
-                future = self._executor.submit(schedule_worker_handler, job)
-            elif key == MONITOR_WORKER_KEY:
-                future = self._executor.submit(monitor_worker_handler, job)
-            elif key == EXEC_WORKER_KEY:
-                future = self._executor.submit(exec_worker_handler, job)
-            else:
+            # 仅从尚有余量的队列中读取任务，全部满载时等待任务完成
+            self.released.clear()
+            capacities = {k: v.capacity for k, v in self.pools.items() if v.capacity > 0}
+            if not capacities:
+                self.released.wait(1)
                 continue
-            future.add_done_callback(self.job_done)
+            count = min(min(capacities.values()), 100)
+            block = 5000 if len(capacities) == len(self.pools) else 1000
+            for key, entry_id, job in jobqueue.read(self.rds, list(capacities), self.consumer, count, block):
+                self.dispatch(key, entry_id, job)
 
 
 class Command(BaseCommand):
     help = 'Start worker process'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=('threads', 'asyncio'), help='批量执行引擎，默认读取配置 EXEC_WORKER_ENGINE')
+        parser.add_argument('--metrics-port', type=int, help='指标采集端口，默认读取配置 METRICS_PORTS')
+
     def handle(self, *args, **options):
+        if options['engine']:
+            settings.EXEC_WORKER_ENGINE = options['engine']
+        metrics.start_server('runworker', options['metrics_port'])
         w = Worker()
         w.run()
@@ -5,6 +5,7 @@ from django.views.generic import View
 from django_redis import get_redis_connection
 from django.conf import settings
 from libs import json_response, JsonParser, Argument, human_datetime, auth
+from libs import jobqueue
 from apps.exec.models import ExecTemplate, ExecHistory
 from apps.host.models import Host
 from apps.account.utils import has_host_perm
@@ -114,9 +115,10 @@ class TaskView(View):
                     command=task.command,
                     pkey=host.private_key,
                     params=json.loads(task.params),
-                    term=term
+                    term=term,
+                    user_id=task.user_id
                 )
-                rds.rpush(settings.EXEC_WORKER_KEY, json.dumps(data))
+                jobqueue.push(rds, settings.EXEC_WORKER_KEY, json.dumps(data))
         return json_response(error=error)
 
 
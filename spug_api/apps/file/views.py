@@ -43,7 +43,7 @@ class ObjectView(View):
             if not host:
                 return json_response(error='未找到指定主机')
             filename = os.path.basename(form.file)
-            ssh_cli = host.get_ssh().get_client()
+            ssh_cli = host.get_ssh(pooled=False).get_client()
             sftp = ssh_cli.open_sftp()
             f = sftp.open(form.file)
             return FileResponseAfter(ssh_cli.close, f, as_attachment=True, filename=filename)
@@ -6,6 +6,7 @@ from libs.helper import make_ali_request, make_tencent_request
 from libs.ssh import SSH, AuthenticationException
 from libs.utils import AttrDict, human_datetime
 from libs.validators import ip_validator
+from libs import logstore
 from apps.host.models import HostExtend
 from apps.setting.utils import AppSetting
 from collections import defaultdict
@@ -251,7 +252,7 @@ def fetch_host_extend(ssh):
 
 def batch_sync_host(token, hosts, password=None):
     private_key, public_key = AppSetting.get_ssh_key()
-    threads, latest_exception, rds = [], None, get_redis_connection()
+    threads, latest_exception, rds, seq = [], None, get_redis_connection(), 0
     max_workers = max(10, os.cpu_count() * 5)
     with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         for host in hosts:
@@ -263,12 +264,12 @@ def batch_sync_host(token, hosts, password=None):
         for t in futures.as_completed(threads):
             exception = t.exception()
             if exception:
-                rds.rpush(token, json.dumps({'key': t.host.id, 'status': 'fail', 'message': f'{exception}'}))
+                seq = logstore.append(rds, token, [{'key': t.host.id, 'status': 'fail', 'message': f'{exception}'}], seq)
             else:
-                rds.rpush(token, json.dumps({'key': t.host.id, 'status': 'ok'}))
+                seq = logstore.append(rds, token, [{'key': t.host.id, 'status': 'ok'}], seq)
                 t.host.is_verified = True
                 t.host.save()
-        rds.expire(token, 60)
+        logstore.expire(rds, token, 60)
 
 
 def _sync_host_extend(host, private_key=None, public_key=None, password=None, ssh=None):
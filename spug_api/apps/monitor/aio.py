@@ -0,0 +1,196 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.conf import settings
+from libs.metrics import MONITOR_PROBE_SECONDS, HTTP_PHASE_SECONDS
+from libs.aio import submit
+from apps.monitor import icmp
+import platform
+import re
+import aiohttp
+import asyncio
+import time
+
+_context = {}
+
+
+# 通过 aiohttp 的 trace 记录请求各阶段的时间点，写入 trace_request_ctx
+async def _on_request_start(session, context, params):
+    context.trace_request_ctx['start'] = time.time()
+
+
+async def _on_connection_create_start(session, context, params):
+    context.trace_request_ctx['connect_start'] = time.time()
+
+
+async def _on_connection_create_end(session, context, params):
+    ctx, now = context.trace_request_ctx, time.time()
+    ctx['connect'] = ctx.get('connect', 0) + now - ctx['connect_start']
+    ctx['ready'] = now
+
+
+async def _on_connection_reuseconn(session, context, params):
+    context.trace_request_ctx['ready'] = time.time()
+
+
+async def _on_request_end(session, context, params):
+    context.trace_request_ctx['end'] = time.time()
+
+
+def _make_trace_config():
+    trace_config = aiohttp.TraceConfig()
+    for name, func in (
+            ('on_request_start', _on_request_start),
+            ('on_connection_create_start', _on_connection_create_start),
+            ('on_connection_create_end', _on_connection_create_end),
+            ('on_connection_reuseconn', _on_connection_reuseconn),
+            ('on_request_end', _on_request_end)):
+        getattr(trace_config, name).append(func)
+    return trace_config
+
+
+def _get_context():
+    if not _context:
+        _context['semaphore'] = asyncio.Semaphore(settings.MONITOR_ASYNC_CONCURRENCY)
+        # 所有站点检测共享一个会话，按源站复用长连接并缓存 DNS 解析结果
+        connector = aiohttp.TCPConnector(
+            limit=settings.MONITOR_HTTP_MAX_CONNECTIONS,
+            limit_per_host=settings.MONITOR_HTTP_MAX_PER_HOST,
+            ttl_dns_cache=settings.MONITOR_HTTP_DNS_TTL,
+            keepalive_timeout=settings.MONITOR_HTTP_KEEPALIVE
+        )
+        _context['session'] = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=settings.MONITOR_HTTP_CONNECT_TIMEOUT,
+                sock_read=settings.MONITOR_HTTP_READ_TIMEOUT
+            ),
+            trace_configs=[_make_trace_config()]
+        )
+    return _context
+
+
+def _error(e):
+    return str(e) or e.__class__.__name__
+
+
+async def _request(session, method, url):
+    # 复用的长连接可能已被服务端关闭，此时重试一次
+    for retry in (True, False):
+        timing = {}
+        try:
+            async with session.request(method, url, trace_request_ctx=timing) as res:
+                # 读完响应内容后连接才能归还连接池复用
+                await res.read()
+                return res.status, timing
+        except aiohttp.ServerDisconnectedError:
+            if not retry or 'connect' in timing:
+                raise
+
+
+async def site_check(session, url, limit):
+    # 分别统计建立连接（含 DNS 与 TLS 握手，复用连接时为 0）与首字节的耗时，响应时间阈值按首字节耗时判断
+    try:
+        method = settings.MONITOR_HTTP_METHOD
+        status, timing = await _request(session, method, url)
+        if status in (405, 501) and method == 'HEAD':
+            status, timing = await _request(session, 'GET', url)
+        connect = int(timing.get('connect', 0) * 1000)
+        ttfb = int((timing['end'] - timing.get('ready', timing['start'])) * 1000)
+        HTTP_PHASE_SECONDS.labels('connect').observe(connect / 1000)
+        HTTP_PHASE_SECONDS.labels('ttfb').observe(ttfb / 1000)
+        if limit and ttfb > int(limit):
+            return False, f'响应时间 {ttfb}ms 大于 {limit}ms（建立连接 {connect}ms）', ttfb
+        return 200 <= status < 400, f'返回HTTP状态码 {status}，建立连接 {connect}ms，首字节 {ttfb}ms', ttfb
+    except Exception as e:
+        return False, _error(e), None
+
+
+async def port_check(addr, port):
+    try:
+        flag = time.time()
+        _, writer = await asyncio.wait_for(asyncio.open_connection(addr, int(port)), 5)
+        writer.close()
+        return True, '端口状态检测正常', round((time.time() - flag) * 1000, 1)
+    except Exception as e:
+        return False, f'异常信息：{_error(e)}', None
+
+
+def _ping_result(sent, rtts, error, limit):
+    # Ping 检测的 extra 为可选的平均延迟阈值（毫秒）
+    if error:
+        return False, f'异常信息：{error}', None
+    if not rtts:
+        return False, 'Ping检测失败，丢包率 100%', None
+    rtt, loss = round(sum(rtts) / len(rtts), 1), round((sent - len(rtts)) * 100 / sent)
+    if limit and rtt > float(limit):
+        return False, f'平均延迟 {rtt}ms 大于 {limit}ms，丢包率 {loss}%', rtt
+    return True, f'Ping检测正常，平均延迟 {rtt}ms，丢包率 {loss}%', rtt
+
+
+async def ping_check(addr, limit):
+    if platform.system().lower() == 'windows':
+        command = ('ping', '-n', '1', '-w', '3000', addr)
+    else:
+        command = ('ping', '-c', '1', '-W', '3', addr)
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            out, _ = await asyncio.wait_for(process.communicate(), 10)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            out = b''
+        if process.returncode != 0:
+            return _ping_result(1, [], None, limit)
+        match = re.search(r'time[=<]\s*([\d.]+)\s*ms', out.decode(errors='ignore'))
+        if not match:
+            return True, 'Ping检测正常', None
+        return _ping_result(1, [float(match.group(1))], None, limit)
+    except Exception as e:
+        return False, f'异常信息：{_error(e)}', None
+
+
+async def _probe(session, tp, addr, extra):
+    async with _get_context()['semaphore']:
+        flag = time.time()
+        if tp == '1':
+            result = await site_check(session, addr, extra)
+        elif tp == '2':
+            result = await port_check(addr, extra)
+        else:
+            result = await ping_check(addr, extra)
+        MONITOR_PROBE_SECONDS.labels(tp, 'ok' if result[0] else 'fail').observe(time.time() - flag)
+        return result
+
+
+async def _ping_sweep(targets, extra):
+    # 同一检测的所有 Ping 目标通过一个 ICMP 套接字批量发送，无可用套接字时逐个执行 ping 命令
+    flag = time.time()
+    data = await icmp.sweep(targets, settings.MONITOR_PING_COUNT)
+    if data is None:
+        return None
+    results = [_ping_result(*data[x], extra) for x in targets]
+    for is_ok, *_ in results:
+        MONITOR_PROBE_SECONDS.labels('5', 'ok' if is_ok else 'fail').observe(time.time() - flag)
+    return results
+
+
+async def _run_probes(tp, targets, extra):
+    if tp == '5' and settings.MONITOR_PING_SWEEP:
+        results = await _ping_sweep(targets, extra)
+        if results is not None:
+            return results
+    session = _get_context()['session']
+    return await asyncio.gather(*(_probe(session, tp, x, extra) for x in targets))
+
+
+# 站点、端口、Ping 检测在共享的事件循环中并发执行，所有检测共用 MONITOR_ASYNC_CONCURRENCY 的并发上限
+# 返回与 targets 顺序一致的 [(is_ok, message, latency)]，latency 为响应/连接/往返耗时（毫秒），未知时为 None
+def run_probes(tp, targets, extra):
+    return submit(_run_probes(tp, targets, extra)).result()
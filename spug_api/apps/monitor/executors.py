@@ -4,33 +4,23 @@
 from django_redis import get_redis_connection
 from apps.host.models import Host
 from apps.monitor.utils import handle_notify
+from apps.monitor.aio import run_probes
+from apps.monitor import history
+from libs.metrics import MONITOR_PROBE_SECONDS
+from django.conf import settings
 from socket import socket
-import subprocess
-import platform
-import requests
 import logging
 import json
 import time
+import uuid
 import re
 
 logging.captureWarnings(True)
-regex = re.compile(r'Failed to establish a new connection: (.*)\'\)+')
 
 
 def site_check(url, limit):
-    try:
-        res = requests.get(url, timeout=30)
-        if limit:
-            duration = int(res.elapsed.total_seconds() * 1000)
-            if duration > int(limit):
-                return False, f'响应时间 {duration}ms 大于 {limit}ms'
-        return 200 <= res.status_code < 400, f'返回HTTP状态码 {res.status_code}'
-    except Exception as e:
-        error = e.__str__()
-        exps = re.findall(regex, error)
-        if exps:
-            error = exps[0]
-        return False, error
+    # 使用异步引擎共享的 HTTP 连接池
+    return run_probes('1', [url], limit)[0][:2]
 
 
 def port_check(addr, port):
@@ -44,19 +34,8 @@ def port_check(addr, port):
         return False, f'异常信息：{e}'
 
 
-def ping_check(addr):
-    try:
-        if platform.system().lower() == 'windows':
-            command = f'ping -n 1 -w 3000 {addr}'
-        else:
-            command = f'ping -c 1 -W 3 {addr}'
-        task = subprocess.run(command, shell=True, stdout=subprocess.PIPE)
-        if task.returncode == 0:
-            return True, 'Ping检测正常'
-        else:
-            return False, 'Ping检测失败'
-    except Exception as e:
-        return False, f'异常信息：{e}'
+def ping_check(addr, limit=None):
+    return run_probes('5', [addr], limit)[0][:2]
 
 
 def host_executor(host, command):
@@ -71,41 +50,133 @@ def host_executor(host, command):
         return False, f'异常信息：{e}'
 
 
+def get_command(tp, extra):
+    if tp == '3':
+        return f'ps -ef|grep -v grep|grep {extra!r}'
+    elif tp == '4':
+        return extra
+    raise TypeError(f'invalid monitor type: {tp!r}')
+
+
+def _make_batch_script(commands, marker):
+    # 各检测命令在独立的子 shell 中并发执行，输出写入临时目录，全部结束后依次输出 "内容 + 分隔行（序号、退出状态码）"
+    # 脚本自身（mktemp、tail 等）的 stderr 也在脚本内合并至 stdout，输出仅有一个流，不依赖 SSH 通道是否合并 stderr
+    limit = settings.MONITOR_SSH_OUTPUT_LIMIT
+    lines = ['exec 2>&1', '_spug_dir=$(mktemp -d) || exit 1']
+    for index, command in enumerate(commands):
+        lines.append(f'{{ (\n{command}\n) >"$_spug_dir/{index}" 2>&1 </dev/null; echo $? >"$_spug_dir/{index}.rc"; }} &')
+    lines.append('wait')
+    lines.append(f'for i in {" ".join(str(x) for x in range(len(commands)))}; do')
+    lines.append(f'  tail -c {limit} "$_spug_dir/$i"; printf "\\n{marker} %s %s\\n" "$i" "$(cat "$_spug_dir/$i.rc" 2>/dev/null || echo 255)"')
+    lines.append('done')
+    lines.append('rm -rf "$_spug_dir"')
+    return '\n'.join(lines)
+
+
+def host_batch_executor(host, commands):
+    # 同一主机的多个检测合并为一个脚本，在一次 SSH 会话中执行，返回与 commands 顺序一致的 [(is_ok, message)]
+    marker = f'__SPUG_CHECK_{uuid.uuid4().hex}__'
+    try:
+        with host.get_ssh() as ssh:
+            _, out = ssh.exec_command_raw(_make_batch_script(commands, marker))
+    except Exception as e:
+        return [(False, f'异常信息：{e}')] * len(commands)
+    results = {}
+    parts = re.split(rf'\n{marker} (\d+) (\d+)', out)
+    for index in range(1, len(parts) - 2, 3):
+        text, exit_code = parts[index - 1].strip(), int(parts[index + 1])
+        if exit_code == 0:
+            results[int(parts[index])] = (True, text or '检测状态正常')
+        else:
+            results[int(parts[index])] = (False, text or f'退出状态码：{exit_code}')
+    return [results.get(x, (False, f'异常信息：未获取到检测结果 {out.strip()[-200:]}')) for x in range(len(commands))]
+
+
+def handle_results(task_id, results, threshold, quiet):
+    # results 为 [(addr, target, is_ok, message, latency)]，批量读写失败计数后按阈值与静默时间发送告警或恢复通知
+    # latency 不为空时记录为 l_{addr}，即最近一次检测的延迟（毫秒）
+    rds, key = get_redis_connection(), f'spug:det:{task_id}'
+    pipe = rds.pipeline(transaction=False)
+    for addr, *_ in results:
+        pipe.hmget(key, f'c_{addr}', f't_{addr}')
+    values = pipe.execute()
+
+    pipe, failures, notifies = rds.pipeline(transaction=False), [], []
+    for (addr, target, is_ok, message, latency), (v_count, v_time) in zip(results, values):
+        if latency is not None:
+            pipe.hset(key, f'l_{addr}', latency)
+        if is_ok:
+            if v_count:
+                pipe.hdel(key, f'c_{addr}', f't_{addr}')
+            if v_time:
+                notifies.append((target, is_ok, message, int(v_count) + 1))
+        else:
+            failures.append((len(pipe), addr, target, message, v_time))
+            pipe.hincrby(key, f'c_{addr}')
+    counts = pipe.execute() if len(pipe) else []
+    try:
+        history.record(rds, task_id, results)
+    except Exception as e:
+        logging.warning(f'record monitor history failed: {e}')
+
+    now = int(time.time())
+    for index, addr, target, message, v_time in failures:
+        v_count = counts[index]
+        if v_count >= threshold:
+            if not v_time or now - int(v_time) >= quiet * 60:
+                rds.hset(key, f't_{addr}', now)
+                notifies.append((target, False, message, v_count))
+    for target, is_ok, message, fault_times in notifies:
+        if is_ok:
+            logging.warning('send recovery notification')
+        else:
+            logging.warning('send fault alarm notification')
+        handle_notify(task_id, target, is_ok, message, fault_times)
+
+
+def monitor_host_handler(host_id, checks):
+    # checks 为同一主机上到期的进程、自定义脚本检测 [[task_id, tp, extra, threshold, quiet]]
+    flag = time.time()
+    host = Host.objects.filter(pk=host_id).first()
+    if host:
+        target = f'{host.name}({host.hostname})'
+        results = host_batch_executor(host, [get_command(x[1], x[2]) for x in checks])
+    else:
+        target = host_id
+        results = [(False, f'unknown host id for {host_id!r}')] * len(checks)
+    for (task_id, tp, _, threshold, quiet), (is_ok, message) in zip(checks, results):
+        MONITOR_PROBE_SECONDS.labels(tp, 'ok' if is_ok else 'fail').observe(time.time() - flag)
+        handle_results(task_id, [(host_id, target, is_ok, message, None)], threshold, quiet)
+
+
 def monitor_worker_handler(job):
-    task_id, tp, addr, extra, threshold, quiet = json.loads(job)
-    target = addr
+    data = json.loads(job)
+    if isinstance(data, dict):
+        return monitor_host_handler(data['host_id'], data['checks'])
+    task_id, tp, addr, extra, threshold, quiet = data
+    if isinstance(addr, list):
+        # 同一检测的所有目标合并为一个任务，由异步引擎并发检测
+        results = run_probes(tp, addr, extra)
+        return handle_results(task_id, [(x, x, *y) for x, y in zip(addr, results)], threshold, quiet)
+
+    target, flag = addr, time.time()
     if tp == '1':
         is_ok, message = site_check(addr, extra)
     elif tp == '2':
         is_ok, message = port_check(addr, extra)
     elif tp == '5':
-        is_ok, message = ping_check(addr)
+        is_ok, message = ping_check(addr, extra)
     elif tp not in ('3', '4'):
         is_ok, message = False, f'invalid monitor type for {tp!r}'
     else:
-        command = f'ps -ef|grep -v grep|grep {extra!r}' if tp == '3' else extra
         host = Host.objects.filter(pk=addr).first()
         if not host:
             is_ok, message = False, f'unknown host id for {addr!r}'
         else:
-            is_ok, message = host_executor(host, command)
-        target = f'{host.name}({host.hostname})'
-
-    rds, key, f_count, f_time = get_redis_connection(), f'spug:det:{task_id}', f'c_{addr}', f't_{addr}'
-    v_count, v_time = rds.hmget(key, f_count, f_time)
-    if is_ok:
-        if v_count:
-            rds.hdel(key, f_count, f_time)
-        if v_time:
-            logging.warning('send recovery notification')
-            handle_notify(task_id, target, is_ok, message, int(v_count) + 1)
-        return
-    v_count = rds.hincrby(key, f_count)
-    if v_count >= threshold:
-        if not v_time or int(time.time()) - int(v_time) >= quiet * 60:
-            rds.hset(key, f_time, int(time.time()))
-            logging.warning('send fault alarm notification')
-            handle_notify(task_id, target, is_ok, message, v_count)
+            is_ok, message = host_executor(host, get_command(tp, extra))
+            target = f'{host.name}({host.hostname})'
+    MONITOR_PROBE_SECONDS.labels(tp, 'ok' if is_ok else 'fail').observe(time.time() - flag)
+    handle_results(task_id, [(addr, target, is_ok, message, None)], threshold, quiet)
 
 
 def dispatch(tp, addr, extra):
@@ -114,12 +185,7 @@ def dispatch(tp, addr, extra):
     elif tp == '2':
         return port_check(addr, extra)
     elif tp == '5':
-        return ping_check(addr)
-    elif tp == '3':
-        command = f'ps -ef|grep -v grep|grep {extra!r}'
-    elif tp == '4':
-        command = extra
-    else:
-        raise TypeError(f'invalid monitor type: {tp!r}')
+        return ping_check(addr, extra)
+    command = get_command(tp, extra)
     host = Host.objects.filter(pk=addr).first()
     return host_executor(host, command)
@@ -0,0 +1,178 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.conf import settings
+from datetime import datetime
+import time
+
+# 监控检测结果的降采样存储，每个检测目标按 MONITOR_HISTORY_RESOLUTIONS 的每种精度各维护一个环形缓冲区，
+# 槽位为 时间桶 % 槽位数，每 CHUNK_SIZE 个槽位存为一个 Hash：{MONITOR_HISTORY_KEY}:{检测ID}:{精度}:{目标}:{槽位 // CHUNK_SIZE}，
+# 字段数不超过 Redis 的 hash-max-listpack-entries 时使用紧凑编码
+# 值为 "时间桶,检测次数,成功次数,延迟总和[,直方图区间:次数...]"，写入的时间桶与槽位中记录的不一致时（上一轮的数据）重置该槽位
+# 每个目标占用的槽位数固定，查询时仅按时间范围 HMGET 对应的槽位
+LATENCY_BOUNDS = (1, 2, 3, 5, 7, 10, 15, 20, 30, 50, 70, 100, 150, 200, 300, 500, 700, 1000, 2000, 5000, 10000)
+CHUNK_SIZE = 128
+
+RECORD_SCRIPT = '''
+local bins = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    local base = 1 + (i - 1) * 6
+    local slot, bucket, ok = ARGV[base + 1], ARGV[base + 2], tonumber(ARGV[base + 3])
+    local bin, latency, ttl = tonumber(ARGV[base + 4]), tonumber(ARGV[base + 5]), ARGV[base + 6]
+    local data, hist, value = nil, {}, redis.call('HGET', key, slot)
+    if value then
+        local parts = {}
+        for x in string.gmatch(value, '[^,]+') do table.insert(parts, x) end
+        if parts[1] == bucket then
+            data = {bucket, tonumber(parts[2]), tonumber(parts[3]), tonumber(parts[4])}
+            for j = 5, #parts do
+                local b, c = string.match(parts[j], '(%d+):(%d+)')
+                hist[tonumber(b)] = tonumber(c)
+            end
+        end
+    end
+    data = data or {bucket, 0, 0, 0}
+    data[2] = data[2] + 1
+    data[3] = data[3] + ok
+    if bin >= 0 then
+        data[4] = data[4] + latency
+        hist[bin] = (hist[bin] or 0) + 1
+    end
+    for b = 0, bins - 1 do
+        if hist[b] then table.insert(data, b .. ':' .. hist[b]) end
+    end
+    redis.call('HSET', key, slot, table.concat(data, ','))
+    redis.call('EXPIRE', key, ttl)
+end
+'''
+
+
+def _make_key(task_id, resolution, target, slot):
+    return f'{settings.MONITOR_HISTORY_KEY}:{task_id}:{resolution}:{target}:{slot // CHUNK_SIZE}'
+
+
+def _get_bin(latency):
+    for index, bound in enumerate(LATENCY_BOUNDS):
+        if latency <= bound:
+            return index
+    return len(LATENCY_BOUNDS)
+
+
+def record(rds, task_id, results, now=None):
+    # results 为 handle_results 的 [(addr, target, is_ok, message, latency)]，一次 EVAL 写入所有目标的各精度
+    now, keys, args = int(now or time.time()), [], [len(LATENCY_BOUNDS) + 1]
+    for addr, _, is_ok, _, latency in results:
+        for resolution, size in settings.MONITOR_HISTORY_RESOLUTIONS:
+            bucket = now // resolution
+            keys.append(_make_key(task_id, resolution, addr, bucket % size))
+            args.extend([
+                bucket % size,
+                bucket * resolution,
+                1 if is_ok else 0,
+                -1 if latency is None else _get_bin(latency),
+                latency or 0,
+                resolution * size
+            ])
+    if keys:
+        rds.eval(RECORD_SCRIPT, len(keys), *keys, *args)
+
+
+def remove(rds, task_id):
+    keys = list(rds.scan_iter(f'{settings.MONITOR_HISTORY_KEY}:{task_id}:*'))
+    if keys:
+        rds.delete(*keys)
+
+
+def _parse(value):
+    bucket, total, ok, latency, *items = value.decode().split(',')
+    hist = [0] * (len(LATENCY_BOUNDS) + 1)
+    for item in items:
+        index, count = item.split(':')
+        hist[int(index)] = int(count)
+    return int(bucket), int(total), int(ok), float(latency), hist
+
+
+def _percentile(hist, percent):
+    # 在直方图所在区间内线性插值，超出最大边界的按最大边界计
+    count = sum(hist)
+    if not count:
+        return None
+    rank, lower = count * percent / 100, 0
+    for index, num in enumerate(hist):
+        upper = LATENCY_BOUNDS[index] if index < len(LATENCY_BOUNDS) else LATENCY_BOUNDS[-1]
+        if num and rank <= num:
+            return round(lower + (upper - lower) * rank / num, 1)
+        rank -= num
+        lower = upper
+    return float(LATENCY_BOUNDS[-1])
+
+
+def _human_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def query(rds, task_id, target, start, end, now=None):
+    # 选择能覆盖起始时间的最高精度，返回可用率、延迟分位数、故障时间段及各时间桶的数据
+    now = int(now or time.time())
+    for resolution, size in settings.MONITOR_HISTORY_RESOLUTIONS:
+        if now - start < resolution * size:
+            break
+    start = max(start, (now // resolution - size + 1) * resolution)
+    buckets = list(range(start // resolution, min(end, now) // resolution + 1))
+    # 按所在的 Hash 分组读取，时间范围跨越环形缓冲区末尾时槽位不连续
+    chunks = {}
+    for bucket in buckets:
+        chunks.setdefault(bucket % size // CHUNK_SIZE, []).append(bucket % size)
+    pipe, values = rds.pipeline(transaction=False), {}
+    for chunk, slots in chunks.items():
+        pipe.hmget(_make_key(task_id, resolution, target, chunk * CHUNK_SIZE), slots)
+    for slots, data in zip(chunks.values(), pipe.execute() if chunks else []):
+        values.update(zip(slots, data))
+
+    total, ok, latency, hist, points, outages = 0, 0, 0.0, [0] * (len(LATENCY_BOUNDS) + 1), [], []
+    for bucket in buckets:
+        value = values.get(bucket % size)
+        if not value:
+            continue
+        b_time, b_total, b_ok, b_latency, b_hist = _parse(value)
+        if b_time != bucket * resolution:
+            continue
+        total, ok, latency = total + b_total, ok + b_ok, latency + b_latency
+        hist = [x + y for x, y in zip(hist, b_hist)]
+        b_count = sum(b_hist)
+        points.append({
+            'time': b_time,
+            'total': b_total,
+            'ok': b_ok,
+            'latency': round(b_latency / b_count, 1) if b_count else None
+        })
+        # 存在失败的时间桶视为故障，相邻的故障时间桶（中间无成功的检测）合并为一个故障时间段
+        if b_ok < b_total:
+            if outages and outages[-1]['recovered'] is False:
+                outages[-1].update(end=b_time + resolution, failures=outages[-1]['failures'] + b_total - b_ok)
+            else:
+                outages.append({'start': b_time, 'end': b_time + resolution, 'failures': b_total - b_ok,
+                                'recovered': False})
+        elif outages:
+            outages[-1]['recovered'] = True
+
+    count = sum(hist)
+    return {
+        'target': target,
+        'resolution': resolution,
+        'total': total,
+        'failures': total - ok,
+        'availability': round(ok * 100 / total, 3) if total else None,
+        'latency': {
+            'avg': round(latency / count, 1) if count else None,
+            'p50': _percentile(hist, 50),
+            'p95': _percentile(hist, 95),
+        },
+        'outages': [{
+            'start': _human_time(x['start']),
+            'end': _human_time(x['end']),
+            'duration': x['end'] - x['start'],
+            'failures': x['failures']
+        } for x in outages],
+        'points': points,
+    }
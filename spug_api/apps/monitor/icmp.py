@@ -0,0 +1,129 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+import itertools
+import asyncio
+import random
+import socket
+import struct
+import time
+
+# 批量 Ping：使用一个 ICMP 套接字向所有目标发送 echo 请求，按 (来源地址, 序号) 匹配回复并计算延迟
+# 优先使用无需 root 权限的 ICMP 数据报套接字（需 net.ipv4.ping_group_range 包含当前用户组），其次为原始套接字
+# 两者均不可用时返回 None，由调用方回退为逐个执行 ping 命令
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _make_packet(ident, seq):
+    payload = b'spug-ping'.ljust(32, b'\0')
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = _checksum(header + payload)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+
+
+def open_socket():
+    for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            sock = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+            sock.setblocking(False)
+            return sock, sock_type == socket.SOCK_RAW
+        except OSError:
+            continue
+    return None, False
+
+
+async def _resolve(loop, addr):
+    try:
+        info = await loop.getaddrinfo(addr, None, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        return info[0][4][0], None
+    except Exception as e:
+        return None, str(e) or e.__class__.__name__
+
+
+class _Sweep:
+    def __init__(self, sock, raw, expected):
+        self.sock = sock
+        self.raw = raw
+        # 原始套接字会收到本机所有的 ICMP 报文，需用标识符过滤；数据报套接字的标识符由内核改写为端口号
+        self.ident = random.randint(0, 0xffff)
+        self.pending = {}
+        self.rtts = {}
+        self.expected = expected
+        self.done = asyncio.Event()
+
+    def send(self, ip, seq):
+        self.pending[(ip, seq)] = time.time()
+        try:
+            self.sock.sendto(_make_packet(self.ident, seq), (ip, 0))
+        except OSError:
+            self.pending.pop((ip, seq))
+            self._check_done()
+
+    def on_readable(self):
+        while True:
+            try:
+                data, (ip, _) = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                break
+            if self.raw:
+                data = data[(data[0] & 0x0f) * 4:]
+            if len(data) < 8:
+                continue
+            tp, _, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+            if tp != ICMP_ECHO_REPLY or (self.raw and ident != self.ident):
+                continue
+            sent_at = self.pending.pop((ip, seq), None)
+            if sent_at is not None:
+                self.rtts.setdefault(ip, []).append((time.time() - sent_at) * 1000)
+                self._check_done()
+
+    def _check_done(self):
+        self.expected -= 1
+        if self.expected <= 0:
+            self.done.set()
+
+
+async def sweep(addrs, count=3, interval=0.2, timeout=3):
+    # 返回 {addr: (sent, [rtt_ms, ...], error)}，无可用 ICMP 套接字时返回 None
+    sock, raw = open_socket()
+    if sock is None:
+        return None
+    loop = asyncio.get_event_loop()
+    try:
+        addrs = list(dict.fromkeys(addrs))
+        resolved = await asyncio.gather(*(_resolve(loop, x) for x in addrs))
+        ips = list(dict.fromkeys(ip for ip, _ in resolved if ip))
+        task = _Sweep(sock, raw, len(ips) * count)
+        loop.add_reader(sock.fileno(), task.on_readable)
+        try:
+            counter = itertools.count(random.randint(0, 0xffff))
+            for index in range(count):
+                if index:
+                    await asyncio.sleep(interval)
+                for ip in ips:
+                    task.send(ip, next(counter) & 0xffff)
+            if ips:
+                try:
+                    await asyncio.wait_for(task.done.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            loop.remove_reader(sock.fileno())
+        result = {}
+        for addr, (ip, error) in zip(addrs, resolved):
+            result[addr] = (count, task.rtts.get(ip, []), error) if ip else (count, [], error)
+        return result
+    finally:
+        sock.close()
@@ -3,6 +3,7 @@
 # Released under the AGPL-3.0 License.
 from django.core.management.base import BaseCommand
 from apps.monitor.scheduler import Scheduler
+from libs import metrics
 import logging
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
@@ -12,5 +13,6 @@ class Command(BaseCommand):
     help = 'Start monitor process'
 
     def handle(self, *args, **options):
+        metrics.start_server('runmonitor')
         s = Scheduler()
         s.run()
@@ -4,18 +4,27 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.util import undefined
 from django_redis import get_redis_connection
 from django.conf import settings
 from django.db import connections
 from django.db.utils import DatabaseError
 from apps.monitor.models import Detection
 from libs import AttrDict, human_datetime
+from libs import jobqueue
 from datetime import datetime, timedelta
 from random import randint
+from math import ceil
+from collections import defaultdict
+from threading import Lock
 import logging
 import json
 
 MONITOR_WORKER_KEY = settings.MONITOR_WORKER_KEY
+# 支持异步引擎的检测类型：站点、端口、Ping
+ASYNC_TYPES = ('1', '2', '5')
+# 基于 SSH 的检测类型：进程、自定义脚本
+SSH_TYPES = ('3', '4')
 
 
 class Scheduler:
@@ -23,26 +32,66 @@ class Scheduler:
 
     def __init__(self):
         self.scheduler = BackgroundScheduler(timezone=self.timezone, executors={'default': ThreadPoolExecutor(30)})
+        self.ssh_checks = defaultdict(dict)
+        self.lock = Lock()
+        self.base_time = datetime.now().replace(microsecond=0)
 
     def _dispatch(self, task_id, tp, targets, extra, threshold, quiet):
         Detection.objects.filter(pk=task_id).update(latest_run_time=human_datetime())
-        rds_cli = get_redis_connection()
-        for t in json.loads(targets):
-            rds_cli.rpush(MONITOR_WORKER_KEY, json.dumps([task_id, tp, t, extra, threshold, quiet]))
+        rds_cli, targets = get_redis_connection(), json.loads(targets)
+        if tp in SSH_TYPES and settings.MONITOR_SSH_BATCH_WINDOW:
+            # 暂存到期的 SSH 检测，由 _flush_ssh_checks 按主机合并后下发
+            with self.lock:
+                for t in targets:
+                    self.ssh_checks[t][task_id] = [task_id, tp, extra, threshold, quiet]
+        elif tp in ASYNC_TYPES and settings.MONITOR_PROBE_ENGINE == 'asyncio':
+            jobqueue.push(rds_cli, MONITOR_WORKER_KEY, json.dumps([task_id, tp, targets, extra, threshold, quiet]))
+        else:
+            for t in targets:
+                jobqueue.push(rds_cli, MONITOR_WORKER_KEY, json.dumps([task_id, tp, t, extra, threshold, quiet]))
         connections.close_all()
 
+    def _flush_ssh_checks(self):
+        # 同一主机上的多个检测合并为一个任务，worker 通过一次 SSH 会话执行
+        with self.lock:
+            ssh_checks, self.ssh_checks = self.ssh_checks, defaultdict(dict)
+        if ssh_checks:
+            rds_cli = get_redis_connection()
+            for host_id, checks in ssh_checks.items():
+                data = {'host_id': host_id, 'checks': list(checks.values())}
+                jobqueue.push(rds_cli, MONITOR_WORKER_KEY, json.dumps(data))
+
+    def _get_next_run_time(self, tp, targets, default):
+        # SSH 检测的首次运行时间按主机（多个主机时取第一个）分散并对齐至合并窗口的起点，
+        # 同一主机上频率相同的检测总是在同一窗口内到期，由 _flush_ssh_checks 合并为一次 SSH 会话
+        window = settings.MONITOR_SSH_BATCH_WINDOW
+        if tp not in SSH_TYPES or not window:
+            return default
+        slots = max(60 // window, 1)
+        targets = json.loads(targets)
+        offset = int(targets[0]) % slots * window if targets else 0
+        start = self.base_time + timedelta(seconds=offset)
+        cycles = max(ceil((datetime.now() - start).total_seconds() / (slots * window)), 0)
+        return start + timedelta(seconds=cycles * slots * window)
+
     def _init(self):
         self.scheduler.start()
+        window = settings.MONITOR_SSH_BATCH_WINDOW
+        if window:
+            # 合并窗口的边界位于两个对齐点的中间，检测到期时间的微小偏差不会跨越窗口
+            trigger = IntervalTrigger(seconds=window, timezone=self.timezone)
+            next_run_time = self.base_time + timedelta(seconds=window / 2)
+            self.scheduler.add_job(self._flush_ssh_checks, trigger, id='flush_ssh_checks', next_run_time=next_run_time)
         try:
             for item in Detection.objects.filter(is_active=True):
-                now = datetime.now()
+                next_run_time = datetime.now() + timedelta(seconds=randint(0, 60))
                 trigger = IntervalTrigger(minutes=int(item.rate), timezone=self.timezone)
                 self.scheduler.add_job(
                     self._dispatch,
                     trigger,
                     id=str(item.id),
                     args=(item.id, item.type, item.targets, item.extra, item.threshold, item.quiet),
-                    next_run_time=now + timedelta(seconds=randint(0, 60))
+                    next_run_time=self._get_next_run_time(item.type, item.targets, next_run_time)
                 )
             connections.close_all()
         except DatabaseError:
@@ -63,6 +112,7 @@ class Scheduler:
                     trigger,
                     id=str(task.id),
                     args=(task.id, task.type, task.targets, task.extra, task.threshold, task.quiet),
+                    next_run_time=self._get_next_run_time(task.type, task.targets, undefined),
                     replace_existing=True
                 )
             elif task.action == 'remove':
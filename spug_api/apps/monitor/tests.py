@@ -0,0 +1,42 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.test import SimpleTestCase, override_settings
+from unittest import mock
+from datetime import timedelta
+from libs.utils import AttrDict
+from apps.monitor import scheduler
+import json
+
+
+@override_settings(MONITOR_SSH_BATCH_WINDOW=10)
+class SSHBatchTest(SimpleTestCase):
+    def test_same_host_one_batch(self):
+        # 同一主机上频率相同的两个 SSH 检测，每一轮均合并为一个任务下发
+        detections = [
+            AttrDict(id=1, type='3', targets='[7]', extra='nginx', threshold=3, quiet=30, rate=1),
+            AttrDict(id=2, type='4', targets='[7]', extra='exit 0', threshold=3, quiet=30, rate=1),
+        ]
+        s = scheduler.Scheduler()
+        with mock.patch.object(s.scheduler, 'start'), \
+                mock.patch.object(scheduler.Detection, 'objects') as objects, \
+                mock.patch.object(scheduler, 'get_redis_connection'), \
+                mock.patch.object(scheduler.jobqueue, 'push') as push:
+            objects.filter.return_value = detections
+            s._init()
+            objects.filter.return_value = mock.Mock()
+            # 按各任务的触发时间模拟运行 5 分钟
+            events, end = [], s.base_time + timedelta(minutes=5)
+            for job in s.scheduler.get_jobs():
+                run_time = job.next_run_time
+                while run_time.replace(tzinfo=None) < end:
+                    events.append((run_time, job.func, job.args))
+                    run_time = job.trigger.get_next_fire_time(run_time, run_time)
+            for _, func, args in sorted(events, key=lambda x: x[0]):
+                func(*args)
+
+        batches = [json.loads(x[0][2]) for x in push.call_args_list]
+        self.assertGreaterEqual(len(batches), 4)
+        for batch in batches:
+            self.assertEqual(batch['host_id'], 7)
+            self.assertEqual(sorted(x[0] for x in batch['checks']), [1, 2])
@@ -9,4 +9,5 @@ urlpatterns = [
     path('', DetectionView.as_view()),
     path('overview/', get_overview),
     path('test/', run_test),
+    path('history/', get_history),
 ]
@@ -7,9 +7,11 @@ from django_redis import get_redis_connection
 from libs import json_response, JsonParser, Argument, human_datetime, auth
 from apps.monitor.models import Detection
 from apps.monitor.executors import dispatch
+from apps.monitor import history
 from apps.setting.utils import AppSetting
 from datetime import datetime
 import json
+import time
 
 
 class DetectionView(View):
@@ -91,6 +93,7 @@ class DetectionView(View):
                 if task.is_active:
                     return json_response(error='该监控项正在运行中，请先停止后再尝试删除')
                 task.delete()
+                history.remove(get_redis_connection(), form.id)
         return json_response(error=error)
 
 
@@ -134,6 +137,9 @@ def get_overview(request):
             for key, val in rds.hgetall(f'spug:det:{item.id}').items():
                 prefix, key = key.decode().split('_', 1)
                 if key in data:
+                    if prefix == 'l':
+                        data[key]['latency'] = float(val)
+                        continue
                     val = int(val)
                     if prefix == 'c':
                         if data[key]['status'] == '1':
@@ -144,3 +150,27 @@ def get_overview(request):
                         data[key].update(status='3', notified_at=date)
         response.extend(list(data.values()))
     return json_response(response)
+
+
+@auth('monitor.monitor.view')
+def get_history(request):
+    # 默认查询最近 24 小时，未指定 target 时返回该检测所有目标的统计
+    form, error = JsonParser(
+        Argument('id', type=int, help='请指定监控项'),
+        Argument('target', required=False),
+        Argument('start', type=int, required=False),
+        Argument('end', type=int, required=False),
+    ).parse(request.GET)
+    if error is None:
+        task = Detection.objects.filter(pk=form.id).first()
+        if not task:
+            return json_response(error='未找到指定监控项')
+        now = int(time.time())
+        end = form.end or now
+        start = form.start or end - 24 * 3600
+        if start >= end:
+            return json_response(error='开始时间需早于结束时间')
+        targets = [form.target] if form.target else [str(x) for x in json.loads(task.targets)]
+        rds = get_redis_connection()
+        return json_response([history.query(rds, task.id, x, start, end, now) for x in targets])
+    return json_response(error=error)
@@ -4,6 +4,7 @@
 from django.db import models
 from django.conf import settings
 from libs.mixins import ModelMixin
+from libs.logstore import delete_archive
 from apps.app.models import App, Environment, Deploy
 from apps.account.models import User
 from datetime import datetime
@@ -50,6 +51,7 @@ class Repository(models.Model, ModelMixin):
         return tmp
 
     def delete(self, using=None, keep_parents=False):
+        delete_archive(f'{settings.BUILD_KEY}:{self.spug_version}')
         super().delete(using, keep_parents)
         try:
             build_file = f'{self.spug_version}.tar.gz'
@@ -0,0 +1,39 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.test import SimpleTestCase
+from libs.utils import AttrDict
+from apps.repository.utils import ArtifactCache
+from git import Repo
+import tempfile
+import os
+
+
+class ArtifactDigestTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.git_dir = self.tmp_dir.name
+        repo = Repo.init(self.git_dir)
+        with open(os.path.join(self.git_dir, 'app.py'), 'w') as f:
+            f.write('print(1)\n')
+        repo.index.add(['app.py'])
+        self.commit = repo.index.commit('init').hexsha
+        self.extend = AttrDict(hook_pre_server='', hook_post_server='npm run build -- --api ${API_URL}')
+        self.filter_rule = {'type': 'contain', 'data': ''}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_digest(self, env):
+        return ArtifactCache.make_digest(self.git_dir, self.commit, self.filter_rule, [], self.extend, env)
+
+    def test_share_between_envs(self):
+        # 环境不同但任务引用的变量相同时复用构建包，未引用的配置不影响
+        test = self.make_digest({'SPUG_ENV_ID': '1', 'SPUG_ENV_KEY': 'test', 'API_URL': 'http://api', 'DB': 'a'})
+        prod = self.make_digest({'SPUG_ENV_ID': '2', 'SPUG_ENV_KEY': 'prod', 'API_URL': 'http://api', 'DB': 'b'})
+        self.assertEqual(test, prod)
+
+    def test_referenced_variable_changed(self):
+        test = self.make_digest({'SPUG_ENV_ID': '1', 'API_URL': 'http://test-api'})
+        prod = self.make_digest({'SPUG_ENV_ID': '2', 'API_URL': 'http://api'})
+        self.assertNotEqual(test, prod)
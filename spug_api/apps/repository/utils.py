@@ -9,12 +9,63 @@ from apps.repository.models import Repository
 from apps.app.utils import fetch_repo
 from apps.config.utils import compose_configs
 from apps.deploy.helper import Helper
+from git import Repo
+from pathlib import Path
+import hashlib
 import json
 import uuid
 import os
+import re
 
 REPOS_DIR = settings.REPOS_DIR
 BUILD_DIR = settings.BUILD_DIR
+BUILD_CACHE_DIR = settings.BUILD_CACHE_DIR
+
+
+# 以构建输入的摘要为键缓存构建包，相同提交再次构建时直接硬链接已有的构建包
+# 构建输入包括代码树、过滤规则、检出前后任务，以及任务中引用的变量（含配置中心的配置），
+# 不包含环境本身，同一提交发布到其他环境时任务引用的变量相同即可复用构建包
+class ArtifactCache:
+    @staticmethod
+    def make_digest(git_dir, tree_ish, filter_rule, files, extend, env):
+        tree_hash = Repo(git_dir).rev_parse(f'{tree_ish}^{{tree}}').hexsha
+        hooks = [extend.hook_pre_server or '', extend.hook_post_server or '']
+        variables = sorted(set(re.findall(r'\$\{?([A-Za-z_]\w*)', ''.join(hooks))))
+        data = [tree_hash, filter_rule['type'], files, hooks, [(x, env.get(x)) for x in variables]]
+        return hashlib.sha256(json.dumps(data, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def fetch(digest, tar_file):
+        cache_file = os.path.join(BUILD_CACHE_DIR, f'{digest}.tar.gz')
+        try:
+            if os.path.exists(tar_file):
+                os.remove(tar_file)
+            os.link(cache_file, tar_file)
+            os.utime(cache_file)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @classmethod
+    def put(cls, digest, tar_file):
+        os.makedirs(BUILD_CACHE_DIR, exist_ok=True)
+        try:
+            os.link(tar_file, os.path.join(BUILD_CACHE_DIR, f'{digest}.tar.gz'))
+        except FileExistsError:
+            pass
+        cls.evict()
+
+    @staticmethod
+    def evict(max_size=None):
+        max_size = settings.BUILD_CACHE_SIZE if max_size is None else max_size
+        if not os.path.isdir(BUILD_CACHE_DIR):
+            return
+        items = sorted(Path(BUILD_CACHE_DIR).iterdir(), key=lambda x: x.stat().st_mtime, reverse=True)
+        total = 0
+        for item in items:
+            total += item.stat().st_size
+            if total > max_size:
+                item.unlink()
 
 
 def dispatch(rep: Repository, helper=None):
@@ -79,6 +130,15 @@ def _build(rep: Repository, helper, env):
     fetch_repo(rep.deploy_id, extend.git_repo)
     helper.send_info('local', '\033[32m完成√\033[0m\r\n')
 
+    filter_rule = json.loads(extend.filter_rule)
+    files = helper.parse_filter_rule(filter_rule['data'], env=env)
+    digest = ArtifactCache.make_digest(git_dir, tree_ish, filter_rule, files, extend, env)
+    if ArtifactCache.fetch(digest, tar_file):
+        helper.send_step('local', 4, f'{human_time()} 命中构建缓存，跳过检出与打包...        ')
+        helper.send_step('local', 5, '\033[32m完成√\033[0m')
+        helper.send_step('local', 100, f'\r\n\r\n{human_time()} ** \033[32m构建成功\033[0m **')
+        return
+
     if extend.hook_pre_server:
         helper.send_step('local', 1, f'{human_time()} 检出前任务...\r\n')
         helper.local(f'cd {git_dir} && {extend.hook_pre_server}', env)
@@ -93,8 +153,7 @@ def _build(rep: Repository, helper, env):
         helper.local(f'cd {build_dir} && {extend.hook_post_server}', env)
 
     helper.send_step('local', 4, f'\r\n{human_time()} 执行打包...        ')
-    filter_rule, exclude, contain = json.loads(extend.filter_rule), '', rep.spug_version
-    files = helper.parse_filter_rule(filter_rule['data'], env=env)
+    exclude, contain = '', rep.spug_version
     if files:
         if filter_rule['type'] == 'exclude':
             excludes = []
@@ -107,5 +166,6 @@ def _build(rep: Repository, helper, env):
         else:
             contain = ' '.join(f'{rep.spug_version}/{x}' for x in files)
     helper.local(f'mkdir -p {BUILD_DIR} && cd {REPOS_DIR} && tar zcf {tar_file} {exclude} {contain}')
+    ArtifactCache.put(digest, tar_file)
     helper.send_step('local', 5, f'\033[32m完成√\033[0m')
     helper.send_step('local', 100, f'\r\n\r\n{human_time()} ** \033[32m构建成功\033[0m **')
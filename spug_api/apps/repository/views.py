@@ -6,6 +6,7 @@ from django.db.models import F
 from django.conf import settings
 from django_redis import get_redis_connection
 from libs import json_response, JsonParser, Argument, human_time, AttrDict, auth
+from libs import logstore
 from apps.repository.models import Repository
 from apps.deploy.models import DeployRequest
 from apps.repository.utils import dispatch
@@ -137,7 +138,7 @@ def get_detail(request, r_id):
     repository = Repository.objects.filter(pk=r_id).first()
     if not repository:
         return json_response(error='未找到指定构建记录')
-    rds, counter = get_redis_connection(), 0
+    rds = get_redis_connection()
     if repository.remarks == 'SPUG AUTO MAKE':
         req = repository.deployrequest_set.filter(repository_id=repository.id, spug_version=repository.spug_version).last()
         if req is not None:
@@ -148,25 +149,17 @@ def get_detail(request, r_id):
         key = f'{settings.BUILD_IMAGE_KEY}:{repository.spug_version}'
     else:
         key = f'{settings.BUILD_KEY}:{repository.spug_version}'
-    data = rds.lrange(key, counter, counter + 9)
     response = AttrDict(data='', step=0, s_status='process', status=repository.status)
-    while data:
-        for item in data:
-            counter += 1
-            item = json.loads(item.decode())
-            if item['key'] == 'local':
-                if 'data' in item:
-                    response.data += item['data']
-                if 'step' in item:
-                    response.step = item['step']
-                if 'status' in item:
-                    response.status = item['status']
-        data = rds.lrange(key, counter, counter + 9)
-    response.index = counter
+    seq, summary = logstore.get_summary(rds, key)
+    response.update((x, y) for x, y in summary.get('local', {}).items() if x != 'seq')
+    for _, item in logstore.iter_logs(rds, key, ['local'], seq):
+        if 'data' in item:
+            response.data += item['data']
+    response.index = seq
     if repository.status in ('0', '1'):
         response.data = f'{human_time()} 建立连接...        ' + response.data
     elif not response.data:
-        response.data = f'{human_time()} 读取数据...        \r\n\r\n未读取到数据，Spug 仅保存最近2周的构建日志。'
+        response.data = f'{human_time()} 读取数据...        \r\n\r\n未读取到数据，日志已被删除或未能归档（未归档的日志仅保存最近{settings.LOG_EXPIRE // 86400}天）。'
     else:
         response.data = f'{human_time()} 读取数据...        ' + response.data
     return json_response(response)
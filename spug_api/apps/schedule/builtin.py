@@ -12,6 +12,7 @@ from apps.exec.models import ExecHistory, Transfer
 from apps.notify.models import Notify
 from apps.deploy.utils import dispatch
 from apps.repository.models import Repository
+from apps.repository.utils import ArtifactCache
 from libs.utils import parse_time, human_datetime, human_date
 from datetime import datetime, timedelta
 from threading import Thread
@@ -70,6 +71,8 @@ def auto_run_by_day():
             except IndexError:
                 pass
 
+        ArtifactCache.evict()
+
         timestamp = time.time() - 2 * 3600
         for item in Path(settings.TRANSFER_DIR).iterdir():
             if item.name != '.gitkeep':
@@ -13,6 +13,7 @@ from apps.schedule.models import Task, History
 from apps.schedule.builtin import auto_run_by_day, auto_run_by_minute
 from django.conf import settings
 from libs import AttrDict, human_datetime
+from libs import jobqueue
 import logging
 import json
 
@@ -73,7 +74,7 @@ class Scheduler:
         Task.objects.filter(pk=task_id).update(latest_id=history.id)
         rds_cli = get_redis_connection()
         for t in targets:
-            rds_cli.rpush(SCHEDULE_WORKER_KEY, json.dumps([history.id, t, interpreter, command]))
+            jobqueue.push(rds_cli, SCHEDULE_WORKER_KEY, json.dumps([history.id, t, interpreter, command]))
         connections.close_all()
 
     def _init(self):
@@ -13,6 +13,7 @@ urlpatterns = [
     url(r'^email_test/$', email_test),
     url(r'^mfa/$', MFAView.as_view()),
     url(r'^about/$', get_about),
+    url(r'^worker/$', get_worker_stats),
     url(r'^push/bind/$', handle_push_bind),
     url(r'^push/balance/$', handle_push_balance),
 ]
@@ -3,7 +3,7 @@
 # Released under the AGPL-3.0 License.
 from functools import lru_cache
 from apps.setting.models import Setting, KEYS_DEFAULT
-from libs.ssh import SSH
+from libs.ssh import SSH, load_private_key, load_async_private_key
 import json
 
 
@@ -28,6 +28,10 @@ class AppSetting:
         if key in KEYS_DEFAULT:
             value = json.dumps(value)
             Setting.objects.update_or_create(key=key, defaults={'value': value, 'desc': desc})
+            if key == 'private_key':
+                cls.get.cache_clear()
+                load_private_key.cache_clear()
+                load_async_private_key.cache_clear()
         else:
             raise KeyError('invalid key')
 
@@ -4,11 +4,14 @@
 import django
 from django.core.cache import cache
 from django.conf import settings
+from django_redis import get_redis_connection
 from libs import JsonParser, Argument, json_response, auth
 from libs.utils import generate_random_str
 from libs.mail import Mail
 from libs.push import get_balance, send_login_code
 from libs.mixins import AdminView
+from libs import jobqueue, metrics
+from django.http.response import HttpResponse
 from apps.setting.utils import AppSetting
 from apps.setting.models import Setting, KEYS_DEFAULT
 from copy import deepcopy
@@ -119,6 +122,25 @@ def get_about(request):
     })
 
 
+@auth('admin')
+def get_worker_stats(request):
+    queues = {
+        'exec': settings.EXEC_WORKER_KEY,
+        'schedule': settings.SCHEDULE_WORKER_KEY,
+        'monitor': settings.MONITOR_WORKER_KEY
+    }
+    stats = jobqueue.get_stats(get_redis_connection(), queues.values())
+    return json_response({k: stats[v] for k, v in queues.items()})
+
+
+def get_metrics(request):
+    # 供 Prometheus 采集，需携带 Authorization: Bearer <METRICS_TOKEN>
+    token = settings.METRICS_TOKEN
+    if not token or request.headers.get('authorization') != f'Bearer {token}':
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.generate(with_queues=True), content_type=metrics.CONTENT_TYPE_LATEST)
+
+
 @auth('admin')
 def handle_push_bind(request):
     form, error = JsonParser(
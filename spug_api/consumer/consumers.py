@@ -2,18 +2,23 @@
 # Copyright: (c) <spug.dev@gmail.com>
 # Released under the AGPL-3.0 License.
 from django.conf import settings
-from django_redis import get_redis_connection
-from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
 from apps.host.models import Host
 from consumer.utils import BaseConsumer
+from consumer.hub import hub
 from apps.account.utils import has_host_perm
 from libs.utils import str_decode
-from threading import Thread
-import time
+from libs.ssh import StreamDecoder
+from libs import logstore
+from collections import deque
+import asyncssh
+import asyncio
 import json
 
 
 class ComConsumer(BaseConsumer):
+    block_timeout = 6000
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         token = self.scope['url_route']['kwargs']['token']
@@ -28,129 +33,189 @@ class ComConsumer(BaseConsumer):
             self.key = token
         else:
             raise TypeError(f'unknown module for {module}')
-        self.rds = get_redis_connection()
+        self.rds = None
+        self.task = None
+        self.index, self.last_seq = 0, 0
+
+    async def init(self):
+        self.rds = await hub.get_pool()
 
-    def disconnect(self, code):
-        self.rds.close()
+    async def disconnect(self, code):
+        if self.task:
+            self.task.cancel()
 
-    def get_response(self, index):
-        counter = 0
-        while counter < 30:
-            response = self.rds.lindex(self.key, index)
-            if response:
-                return response.decode()
-            counter += 1
-            time.sleep(0.2)
+    async def receive(self, text_data='', **kwargs):
+        # 推送在后台任务中进行，避免阻塞等待期间无法处理断开等事件
+        if self.rds and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(self.forward(text_data))
 
-    def receive(self, text_data='', **kwargs):
+    async def forward(self, text_data):
         if text_data.isdigit():
             index = int(text_data)
-            response = self.get_response(index)
-            while response:
-                index += 1
-                self.send(text_data=response)
-                response = self.get_response(index)
-        self.send(text_data='pong')
+            if await logstore.is_legacy_async(self.rds, self.key):
+                for item in await self.rds.lrange(self.key, index, -1):
+                    await self.send(text_data=item.decode())
+            else:
+                # 前端以已接收的消息数作为断点，与序号一致；序号因重试存在间隔时以本地记录的序号为准
+                # 阻塞等待新日志，最长 6 秒无新消息则返回 pong 由前端重新发起
+                if index != self.index:
+                    self.index, self.last_seq = index, index
+                entries = await self._read()
+                while entries:
+                    for self.last_seq, data in entries:
+                        await self.send(text_data=data)
+                    self.index += len(entries)
+                    entries = await self._read()
+        await self.send(text_data='pong')
+
+    def _read(self):
+        return logstore.read_async(self.rds, self.key, self.last_seq, self.block_timeout, wait=hub.wait_feed)
 
 
 class SSHConsumer(BaseConsumer):
+    flush_size = 64 * 1024
+    flush_interval = 0.01
+    max_unacked = 1024 * 1024
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.id = self.scope['url_route']['kwargs']['id']
-        self.chan = None
-        self.ssh = None
-
-    def loop_read(self):
-        is_ready, data = False, b''
+        self.conn = None
+        self.process = None
+        self.task = None
+        self.frames = deque()
+        self.unacked = 0
+        self.acked = asyncio.Event()
+        self.flow_control = False
+
+    async def send_frame(self, text):
+        # send 仅将帧放入发送队列，不等待浏览器接收，需由前端渲染完每一帧后回复 ack 实现流控
+        self.frames.append(len(text))
+        self.unacked += len(text)
+        await self.send(text_data=text)
+
+    def ack(self):
+        # 收到 ack 说明前端支持流控，兼容未回复 ack 的旧版本前端
+        self.flow_control = True
+        if self.frames:
+            self.unacked -= self.frames.popleft()
+        if self.unacked <= self.max_unacked:
+            self.acked.set()
+
+    async def loop_read(self):
+        # 输出按 10ms / 64KB 窗口合并为一帧发送，未确认的输出超过 max_unacked 时暂停读取，
+        # 由 SSH 通道窗口对远端形成背压，避免浏览器处理缓慢时在服务端堆积
+        loop = asyncio.get_event_loop()
+        decoder, deadline = StreamDecoder(), 0
+        buffer, size = ['\033[2J\033[3J\033[1;1H'], 0
         while True:
-            out = self.chan.recv(32 * 1024)
-            if not out:
-                self.close(3333)
-                break
-            data += out
+            timeout = max(deadline - loop.time(), 0) if size else None
             try:
-                text = data.decode()
-            except UnicodeDecodeError:
-                try:
-                    text = data.decode(encoding='GBK')
-                except UnicodeDecodeError:
-                    time.sleep(0.01)
-                    if self.chan.recv_ready():
-                        continue
-                    text = data.decode(errors='ignore')
-
-            if not is_ready:
-                self.send(text_data='\033[2J\033[3J\033[1;1H')
-                is_ready = True
-            self.send(text_data=text)
-            data = b''
-
-    def receive(self, text_data=None, bytes_data=None):
+                data = await asyncio.wait_for(self.process.stdout.read(self.flush_size), timeout)
+            except asyncio.TimeoutError:
+                data = None
+            except asyncssh.Error:
+                data = b''
+            if data:
+                if not size:
+                    deadline = loop.time() + self.flush_interval
+                buffer.append(decoder.decode(data))
+                size += len(data)
+                if size < self.flush_size:
+                    continue
+            elif data is not None:
+                buffer.append(decoder.decode(data, True))
+            text = ''.join(buffer)
+            if text:
+                await self.send_frame(text)
+            buffer, size = [], 0
+            if data is not None and not data:
+                await self.close(3333)
+                break
+            while self.flow_control and self.unacked > self.max_unacked:
+                self.acked.clear()
+                await self.acked.wait()
+
+    async def receive(self, text_data=None, bytes_data=None):
         data = text_data or bytes_data
-        if data and self.chan:
+        if data and self.user:
             data = json.loads(data)
+            if 'ack' in data:
+                return self.ack()
+        if data and self.process:
             # print('write: {!r}'.format(data))
             resize = data.get('resize')
             if resize and len(resize) == 2:
-                self.chan.resize_pty(*resize)
+                self.process.change_terminal_size(*resize)
             else:
-                self.chan.send(data['data'])
-
-    def disconnect(self, code):
-        if self.chan:
-            self.chan.close()
-        if self.ssh:
-            self.ssh.close()
-
-    def init(self):
-        if has_host_perm(self.user, self.id):
-            self.send(text_data='\r\n正在连接至主机 ...')
-            host = Host.objects.filter(pk=self.id).first()
+                self.process.stdin.write(data['data'].encode())
+
+    async def disconnect(self, code):
+        if self.task:
+            self.task.cancel()
+        if self.process:
+            self.process.close()
+        if self.conn:
+            self.conn.close()
+
+    async def init(self):
+        if await database_sync_to_async(has_host_perm)(self.user, self.id):
+            await self.send_frame('\r\n正在连接至主机 ...')
+            host = await database_sync_to_async(Host.objects.filter(pk=self.id).first)()
             if not host:
-                return self.close_with_message('未找到指定主机，请刷新页面重试。')
+                return await self.close_with_message('未找到指定主机，请刷新页面重试。')
 
             try:
-                self.ssh = host.get_ssh().get_client()
+                ssh = await database_sync_to_async(host.get_ssh)(pooled=False)
+                self.conn = await ssh.connect_async(keepalive_interval=30)
+                self.process = await self.conn.create_process(term_type='xterm', term_size=(80, 24), encoding=None)
             except Exception as e:
-                return self.close_with_message(f'连接主机失败: {e}')
+                return await self.close_with_message(f'连接主机失败: {e}')
 
-            self.chan = self.ssh.invoke_shell(term='xterm')
-            self.chan.transport.set_keepalive(30)
-            Thread(target=self.loop_read).start()
+            self.task = asyncio.ensure_future(self.loop_read())
         else:
-            self.close_with_message('你当前无权限操作该主机，请联系管理员授权。')
+            await self.close_with_message('你当前无权限操作该主机，请联系管理员授权。')
 
 
 class NotifyConsumer(BaseConsumer):
-    def init(self):
-        async_to_sync(self.channel_layer.group_add)('notify', self.channel_name)
+    async def init(self):
+        await self.channel_layer.group_add('notify', self.channel_name)
 
-    def disconnect(self, code):
-        async_to_sync(self.channel_layer.group_discard)('notify', self.channel_name)
+    async def disconnect(self, code):
+        await self.channel_layer.group_discard('notify', self.channel_name)
 
-    def receive(self, **kwargs):
-        self.send(text_data='pong')
+    async def receive(self, **kwargs):
+        await self.send(text_data='pong')
 
-    def notify_message(self, event):
-        self.send(text_data=json.dumps(event))
+    async def notify_message(self, event):
+        await self.send(text_data=json.dumps(event))
 
 
 class PubSubConsumer(BaseConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.token = self.scope['url_route']['kwargs']['token']
-        self.rds = get_redis_connection()
-        self.p = self.rds.pubsub(ignore_subscribe_messages=True)
-        self.p.subscribe(self.token)
-
-    def disconnect(self, code):
-        self.p.close()
-        self.rds.close()
-
-    def receive(self, **kwargs):
-        response = self.p.get_message(timeout=10)
-        while response:
-            data = str_decode(response['data'])
-            self.send(text_data=data)
-            response = self.p.get_message(timeout=10)
-        self.send(text_data='pong')
+        self.queue = None
+        self.task = None
+
+    async def init(self):
+        self.queue = await hub.subscribe(self.token)
+
+    async def disconnect(self, code):
+        if self.task:
+            self.task.cancel()
+        if self.queue:
+            await hub.unsubscribe(self.token, self.queue)
+
+    async def receive(self, **kwargs):
+        if self.queue and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(self.forward())
+
+    async def forward(self):
+        try:
+            while True:
+                data = await asyncio.wait_for(self.queue.get(), 10)
+                await self.send(text_data=str_decode(data))
+        except asyncio.TimeoutError:
+            pass
+        await self.send(text_data='pong')
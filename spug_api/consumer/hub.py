@@ -0,0 +1,150 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.conf import settings
+from uuid import uuid4
+import aioredis
+import asyncio
+import logging
+
+
+def _parse_id(entry_id):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    return tuple(int(x) for x in entry_id.split('-'))
+
+
+# 进程内所有 websocket 共享 Redis 连接，单个连接不再随 websocket 数量增长：
+# 普通命令使用连接池；日志的阻塞等待由一个后台任务在专用连接上通过一次 XREAD BLOCK 等待所有关注的 feed；
+# 订阅由一个专用连接完成，每个频道一个任务分发给该频道的所有 websocket
+class RedisHub:
+    block_timeout = 5000
+
+    def __init__(self):
+        self.address = settings.CACHES['default']['LOCATION']
+        self.wake_key = f'spug:ws:wake:{uuid4().hex}'
+        self.lock = None
+        self.pool = None
+        self.feeds = {}
+        self.reading = {}
+        self.feed_task = None
+        self.pubsub = None
+        self.channels = {}
+
+    async def get_pool(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.pool is None or self.pool.closed:
+                self.pool = await aioredis.create_redis_pool(self.address, maxsize=20)
+        return self.pool
+
+    async def wait_feed(self, key, last_id, timeout):
+        # 等待 Stream key 中出现 ID 大于 last_id 的消息，超时返回 False
+        pool = await self.get_pool()
+        future = asyncio.get_event_loop().create_future()
+        waiter = (_parse_id(last_id), future)
+        self.feeds.setdefault(key, []).append(waiter)
+        if self.feed_task is None or self.feed_task.done():
+            self.feed_task = asyncio.ensure_future(self._read_feeds())
+        # 新关注的 key 或需要读取更早的消息时，唤醒阻塞中的 XREAD 重新发起
+        current = self.reading.get(key)
+        if current is None or waiter[0] < current:
+            await pool.xadd(self.wake_key, {'k': key}, max_len=100, exact_len=False)
+            await pool.expire(self.wake_key, 600)
+        try:
+            return await asyncio.wait_for(future, timeout / 1000)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self.feeds.get(key, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self.feeds.pop(key, None)
+
+    async def _read_feeds(self):
+        conn, wake_id = None, '0-0'
+        try:
+            while self.feeds:
+                if conn is None or conn.closed:
+                    conn = await aioredis.create_redis(self.address)
+                waiters = {k: [x for x, y in v if not y.done()] for k, v in self.feeds.items()}
+                self.reading = {k: min(v) for k, v in waiters.items() if v}
+                if not self.reading:
+                    await asyncio.sleep(0)
+                    continue
+                keys = list(self.reading)
+                ids = ['%d-%d' % x for x in self.reading.values()]
+                try:
+                    entries = await conn.xread([self.wake_key] + keys, timeout=self.block_timeout,
+                                               latest_ids=[wake_id] + ids)
+                except (aioredis.RedisError, OSError) as e:
+                    logging.warning(f'read log feeds failed: {e}')
+                    self._notify_all()
+                    conn.close()
+                    await asyncio.sleep(1)
+                    continue
+                for key, entry_id, _ in entries:
+                    key = key.decode()
+                    if key == self.wake_key:
+                        wake_id = entry_id.decode()
+                        continue
+                    entry_id = _parse_id(entry_id)
+                    for last_id, future in self.feeds.get(key, []):
+                        if entry_id > last_id and not future.done():
+                            future.set_result(True)
+        finally:
+            self.reading = {}
+            if conn is not None:
+                conn.close()
+
+    def _notify_all(self):
+        # Redis 连接异常时让所有等待者返回，由前端重新发起
+        for waiters in self.feeds.values():
+            for _, future in waiters:
+                if not future.done():
+                    future.set_result(False)
+
+    async def subscribe(self, name):
+        # 返回接收该频道消息的队列，连接断开后由后台任务自动重新订阅
+        queue = asyncio.Queue()
+        queues = self.channels.setdefault(name, set())
+        queues.add(queue)
+        if len(queues) == 1:
+            asyncio.ensure_future(self._forward_channel(name, queues))
+        return queue
+
+    async def unsubscribe(self, name, queue):
+        queues = self.channels.get(name, set())
+        queues.discard(queue)
+        if not queues:
+            self.channels.pop(name, None)
+            if self.pubsub and not self.pubsub.closed:
+                await self.pubsub.unsubscribe(name)
+
+    async def _get_pubsub(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.pubsub is None or self.pubsub.closed:
+                self.pubsub = await aioredis.create_redis(self.address)
+        return self.pubsub
+
+    async def _forward_channel(self, name, queues):
+        while self.channels.get(name) is queues:
+            try:
+                pubsub = await self._get_pubsub()
+                channel, = await pubsub.subscribe(name)
+                while True:
+                    data = await channel.get()
+                    if data is None:
+                        break
+                    for queue in list(queues):
+                        queue.put_nowait(data)
+            except (aioredis.RedisError, OSError) as e:
+                logging.warning(f'subscribe {name} failed: {e}')
+                await asyncio.sleep(1)
+
+
+hub = RedisHub()
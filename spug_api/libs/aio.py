@@ -0,0 +1,22 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+import threading
+import asyncio
+
+_loop = None
+_lock = threading.Lock()
+
+
+# 进程内共享的事件循环，运行在独立的守护线程中，供同步代码提交协程
+def get_event_loop():
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+
+def submit(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
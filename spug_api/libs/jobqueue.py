@@ -0,0 +1,100 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.conf import settings
+from redis.exceptions import ResponseError
+from uuid import uuid4
+import socket
+import json
+import os
+
+# 执行、监控、任务计划的任务队列基于 Redis Stream 消费组实现，可在多个节点上同时运行多个 runworker
+# 任务执行完成后 XACK 并删除，未确认的任务保留在 PEL 中，worker 崩溃后由其他存活的 worker 认领
+# consumer 名称包含进程级的随机后缀，容器重启后 hostname 与 pid 相同的新进程也不会沿用旧名称，其遗留的任务可被认领
+# 每个 worker 定期刷新存活标记 {WORKER_ALIVE_KEY}:{consumer}，仅认领已失去存活标记的 consumer 的任务，
+# 避免长耗时任务被重复执行，存活标记的值为该 worker 各队列的运行统计
+FIELD = b'data'
+
+
+def push(rds, key, data):
+    return rds.xadd(key, {FIELD: data})
+
+
+def get_consumer_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+
+
+def create_group(rds, key):
+    # 兼容旧版本以 List 存储的队列
+    if rds.type(key) == b'list':
+        rds.delete(key)
+    try:
+        rds.xgroup_create(key, settings.WORKER_GROUP, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def read(rds, keys, consumer, count=10, block=5000):
+    # 返回 [(key, entry_id, data)]
+    response = rds.xreadgroup(settings.WORKER_GROUP, consumer, {x: '>' for x in keys}, count=count, block=block)
+    return [(key.decode(), x, y[FIELD]) for key, entries in response or [] for x, y in entries]
+
+
+def ack(rds, key, entry_id):
+    pipe = rds.pipeline()
+    pipe.xack(key, settings.WORKER_GROUP, entry_id)
+    pipe.xdel(key, entry_id)
+    pipe.execute()
+
+
+def keepalive(rds, consumer, ttl, stats=None):
+    rds.set(f'{settings.WORKER_ALIVE_KEY}:{consumer}', json.dumps(stats or {}), ex=ttl)
+
+
+def get_stats(rds, keys):
+    # 汇总各队列的积压数（depth）、执行中（pending）及所有存活 worker 的统计
+    # wait_seconds / exec_seconds 为累计的排队 / 执行耗时，除以 jobs 即平均值
+    result = {}
+    for key in keys:
+        try:
+            pending = rds.xpending(key, settings.WORKER_GROUP)['pending']
+        except ResponseError:
+            pending = 0
+        result[key] = {'depth': max(0, rds.xlen(key) - pending), 'pending': pending, 'workers': 0,
+                       'running': 0, 'waiting': 0, 'jobs': 0, 'wait_seconds': 0.0, 'exec_seconds': 0.0}
+    for name in rds.scan_iter(f'{settings.WORKER_ALIVE_KEY}:*'):
+        data = rds.get(name)
+        stats = json.loads(data) if data else {}
+        if not isinstance(stats, dict):
+            continue
+        for key, item in stats.items():
+            if key in result:
+                result[key]['workers'] += 1
+                for field in ('running', 'waiting', 'jobs', 'wait_seconds', 'exec_seconds'):
+                    result[key][field] += item.get(field, 0)
+    return result
+
+
+def claim(rds, key, consumer, count=100):
+    # 认领已失去存活标记的 consumer 未确认的任务，最多 count 个，返回 [(key, entry_id, data)]
+    group, jobs = settings.WORKER_GROUP, []
+    for item in rds.xinfo_consumers(key, group):
+        name = item['name'].decode() if isinstance(item['name'], bytes) else item['name']
+        if len(jobs) >= count:
+            break
+        if name == consumer or rds.exists(f'{settings.WORKER_ALIVE_KEY}:{name}'):
+            continue
+        limit = count - len(jobs)
+        pending = rds.xpending_range(key, group, '-', '+', limit, consumername=name)
+        if pending:
+            # min_idle_time 保证多个 worker 同时认领时只有一个能成功
+            entries = rds.xclaim(key, group, consumer, 1000, [x['message_id'] for x in pending])
+            for entry_id, data in entries:
+                if data and FIELD in data:
+                    jobs.append((key, entry_id, data[FIELD]))
+                else:
+                    ack(rds, key, entry_id)
+        if len(pending) < limit:
+            rds.xgroup_delconsumer(key, group, name)
+    return jobs
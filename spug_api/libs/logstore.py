@@ -0,0 +1,292 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.conf import settings
+from uuid import uuid4
+import asyncio
+import shutil
+import heapq
+import gzip
+import json
+import os
+
+# 发布/构建日志按消息的 key（主机ID、local、image）分片存储为多个 Redis Stream：{key}:{k}
+# 各分片 entry 的 ID 为全局递增的序号 <seq>-0，按序号合并即可还原完整的日志顺序
+# {key}:index 为 Hash，记录最新序号 seq 及各分片的 <k>:seq、<k>:step、<k>:status，用于获取步骤概要
+# {key}:feed 为仅保留少量记录的 Stream，每次写入追加一条，供 websocket 阻塞等待新日志
+# 结束的日志归档为 LOG_ARCHIVE_DIR 下的 gzip 分段文件，每段最多 LOG_ARCHIVE_SEGMENT 条，按序号范围定位分段
+# 兼容旧版本以单个 List 存储的日志（只读，重试发布时会转换为分片存储）
+FIELD = b'data'
+SUMMARY_FIELDS = ('seq', 'step', 'status')
+
+
+def _shard(key, k):
+    return f'{key}:{k}'
+
+
+def _get_seq(entry_id):
+    return int(entry_id.split(b'-')[0])
+
+
+def _parse_index(data):
+    seq, summary = 0, {}
+    for field, value in data.items():
+        field, value = field.decode(), value.decode()
+        if field == 'seq':
+            seq = int(value)
+        else:
+            k, name = field.rsplit(':', 1)
+            summary.setdefault(k, {})[name] = int(value) if name in ('seq', 'step') else value
+    return seq, summary
+
+
+def _is_legacy(rds, key):
+    return rds.type(key) == b'list'
+
+
+def _archive_dir(key):
+    return os.path.join(settings.LOG_ARCHIVE_DIR, *key.split(':'))
+
+
+def _load_archive(key):
+    try:
+        with open(os.path.join(_archive_dir(key), 'index.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _iter_segments(path, segments, start, end):
+    for first, last, name in segments:
+        if last < start or first > end:
+            continue
+        with gzip.open(os.path.join(path, name), 'rt') as f:
+            for line in f:
+                seq, item = line.split('\t', 1)
+                seq = int(seq)
+                if seq > end:
+                    break
+                if seq >= start:
+                    yield seq, json.loads(item)
+
+
+def _iter_archive(key, archive, keys, start, end):
+    path, iterators = _archive_dir(key), []
+    for k, segments in archive['segments'].items():
+        if keys is None or k in keys:
+            iterators.append(_iter_segments(path, segments, start, end))
+    return heapq.merge(*iterators, key=lambda x: x[0])
+
+
+def archive(rds, key, ttl=300):
+    # 日志写入完成后归档到磁盘，Redis 中的数据短暂保留以便 websocket 读取最后的消息
+    seq, summary = _parse_index(rds.hgetall(f'{key}:index'))
+    if seq == 0:
+        return expire(rds, key, ttl)
+    path = _archive_dir(key)
+    tmp_path = f'{path}.{uuid4().hex}'
+    os.makedirs(tmp_path)
+    segments = {}
+    try:
+        for k in summary:
+            segments[k], f, count = [], None, 0
+            for s, item in _iter_shard(rds, _shard(key, k), 1, seq, 1000):
+                if f is None or count >= settings.LOG_ARCHIVE_SEGMENT:
+                    if f:
+                        f.close()
+                    segments[k].append([s, s, f'{k}.{s}.gz'])
+                    f, count = gzip.open(os.path.join(tmp_path, segments[k][-1][2]), 'wt'), 0
+                f.write(f'{s}\t{json.dumps(item)}\n')
+                segments[k][-1][1] = s
+                count += 1
+            if f:
+                f.close()
+        with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+            json.dump({'seq': seq, 'summary': summary, 'segments': segments}, f)
+        shutil.rmtree(path, True)
+        os.rename(tmp_path, path)
+    except Exception:
+        shutil.rmtree(tmp_path, True)
+        raise
+    expire(rds, key, ttl)
+
+
+def _restore(rds, key, archive, excludes):
+    # 重试发布时将归档日志恢复至 Redis
+    path, seq, index = _archive_dir(key), archive['seq'], {'seq': archive['seq']}
+    for k, segments in archive['segments'].items():
+        if k in excludes:
+            continue
+        pipe = rds.pipeline(transaction=False)
+        for s, item in _iter_segments(path, segments, 1, seq):
+            pipe.xadd(_shard(key, k), {FIELD: json.dumps(item)}, id=f'{s}-0')
+            if len(pipe) >= 1000:
+                pipe.execute()
+        pipe.execute()
+        index.update((f'{k}:{x}', y) for x, y in archive['summary'][k].items())
+    rds.hset(f'{key}:index', mapping=index)
+
+
+def append(rds, key, messages, seq=0):
+    # 写入日志并返回最新序号，同一日志同时只应有一个写入方
+    index = {}
+    pipe = rds.pipeline()
+    for item in messages:
+        seq += 1
+        k = item['key']
+        pipe.xadd(_shard(key, k), {FIELD: json.dumps(item)}, id=f'{seq}-0')
+        index[f'{k}:seq'] = seq
+        for name in ('step', 'status'):
+            if name in item:
+                index[f'{k}:{name}'] = item[name]
+    if index:
+        index['seq'] = seq
+        pipe.hset(f'{key}:index', mapping=index)
+        pipe.xadd(f'{key}:feed', {'seq': seq}, id=f'{seq}-0', maxlen=16, approximate=True)
+        pipe.execute()
+    return seq
+
+
+def get_summary(rds, key):
+    if _is_legacy(rds, key):
+        seq, summary = 0, {}
+        for seq, item in iter_logs(rds, key):
+            tmp = summary.setdefault(str(item['key']), {})
+            tmp['seq'] = seq
+            tmp.update((x, item[x]) for x in ('step', 'status') if x in item)
+        return seq, summary
+    data = rds.hgetall(f'{key}:index')
+    if not data:
+        archive = _load_archive(key)
+        if archive:
+            return archive['seq'], archive['summary']
+    return _parse_index(data)
+
+
+def get_seq(rds, key):
+    if _is_legacy(rds, key):
+        return rds.llen(key)
+    seq = rds.hget(f'{key}:index', 'seq')
+    if seq is None:
+        archive = _load_archive(key)
+        return archive['seq'] if archive else 0
+    return int(seq)
+
+
+def _iter_legacy(rds, key, batch):
+    counter = 0
+    data = rds.lrange(key, counter, counter + batch - 1)
+    while data:
+        yield from data
+        counter += len(data)
+        data = rds.lrange(key, counter, counter + batch - 1)
+
+
+def _iter_shard(rds, shard, start, end, batch):
+    while start <= end:
+        entries = rds.xrange(shard, start, end, count=batch)
+        for x, y in entries:
+            yield _get_seq(x), json.loads(y[FIELD])
+        if len(entries) < batch:
+            break
+        start = _get_seq(entries[-1][0]) + 1
+
+
+def iter_logs(rds, key, keys=None, end=None, start=1, batch=1000):
+    # 按序号顺序返回 [start, end] 范围内的 (seq, message)，keys 指定时仅读取对应分片
+    keys = {str(x) for x in keys} if keys is not None else None
+    legacy = _is_legacy(rds, key)
+    data = None if legacy else rds.hgetall(f'{key}:index')
+    if legacy:
+        for seq, item in enumerate(_iter_legacy(rds, key, batch), 1):
+            if end is not None and seq > end:
+                break
+            item = json.loads(item)
+            if seq >= start and (keys is None or str(item['key']) in keys):
+                yield seq, item
+    elif data:
+        seq, summary = _parse_index(data)
+        end = seq if end is None else min(end, seq)
+        shards = [k for k in summary if keys is None or k in keys]
+        iterators = [_iter_shard(rds, _shard(key, k), start, end, batch) for k in shards]
+        yield from heapq.merge(*iterators, key=lambda x: x[0])
+    else:
+        archive = _load_archive(key)
+        if archive:
+            end = archive['seq'] if end is None else min(end, archive['seq'])
+            yield from _iter_archive(key, archive, keys, start, end)
+
+
+def _all_keys(rds, key):
+    _, summary = _parse_index(rds.hgetall(f'{key}:index'))
+    return [_shard(key, k) for k in summary] + [f'{key}:index', f'{key}:feed', key]
+
+
+def delete(rds, key):
+    rds.delete(*_all_keys(rds, key))
+    delete_archive(key)
+
+
+def delete_archive(key):
+    shutil.rmtree(_archive_dir(key), True)
+
+
+def expire(rds, key, ttl):
+    pipe = rds.pipeline(transaction=False)
+    for item in _all_keys(rds, key):
+        pipe.expire(item, ttl)
+    pipe.execute()
+
+
+def remove(rds, key, keys):
+    # 删除指定 key 的日志分片，用于仅重试失败的主机
+    keys = [str(x) for x in keys]
+    if _is_legacy(rds, key):
+        tmp_key, seq, messages = f'{key}_tmp', 0, []
+        delete(rds, tmp_key)
+        for _, item in iter_logs(rds, key):
+            if str(item['key']) not in keys:
+                messages.append(item)
+                if len(messages) >= 1000:
+                    seq, messages = append(rds, tmp_key, messages, seq), []
+        append(rds, tmp_key, messages, seq)
+        rds.delete(key)
+        for item in _all_keys(rds, tmp_key)[:-1]:
+            if rds.exists(item):
+                rds.rename(item, key + item[len(tmp_key):])
+    elif rds.exists(f'{key}:index'):
+        pipe = rds.pipeline()
+        pipe.delete(*(_shard(key, k) for k in keys))
+        pipe.hdel(f'{key}:index', *(f'{k}:{x}' for k in keys for x in SUMMARY_FIELDS))
+        for item in _all_keys(rds, key):
+            pipe.persist(item)
+        pipe.execute()
+    else:
+        archive = _load_archive(key)
+        if archive:
+            _restore(rds, key, archive, keys)
+    delete_archive(key)
+
+
+# 以下为 aioredis 版本，供异步 websocket 使用
+async def is_legacy_async(redis, key):
+    return await redis.type(key) == b'list'
+
+
+async def read_async(redis, key, last_seq, block=6000, count=1000, wait=None):
+    # 返回序号大于 last_seq 的日志 [(seq, data)]，无新日志时最长阻塞 block 毫秒
+    # 索引与分片在同一事务中写入，依据索引快照读取各分片即可保证不遗漏、不乱序
+    # wait(feed_key, last_id, block) 可替代在 redis 连接上直接阻塞等待 feed
+    seq, summary = _parse_index(await redis.hgetall(f'{key}:index'))
+    if seq <= last_seq:
+        if wait is not None:
+            if not await wait(f'{key}:feed', f'{last_seq}-0', block):
+                return []
+        elif not await redis.xread([f'{key}:feed'], timeout=block, latest_ids=[f'{last_seq}-0']):
+            return []
+        seq, summary = _parse_index(await redis.hgetall(f'{key}:index'))
+    end = min(seq, last_seq + count)
+    shards = [k for k, v in summary.items() if v.get('seq', 0) > last_seq]
+    results = await asyncio.gather(*(redis.xrange(_shard(key, k), str(last_seq + 1), str(end)) for k in shards))
+    entries = [(_get_seq(x), y[FIELD].decode()) for result in results for x, y in result]
+    return sorted(entries, key=lambda x: x[0])
@@ -0,0 +1,156 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+from django.conf import settings
+from django.db import connection
+from django.utils.deprecation import MiddlewareMixin
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, generate_latest, start_http_server
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client import multiprocess
+from django_redis.pool import ConnectionFactory
+from redis.connection import Connection
+import logging
+import time
+import os
+
+# Prometheus 指标，API 进程通过 /metrics/ 暴露，runworker/runmonitor/runscheduler 按 METRICS_PORTS 启动独立的采集端口
+# gunicorn 多进程运行时需设置环境变量 PROMETHEUS_MULTIPROC_DIR，由各进程写入共享目录后汇总
+SSH_CONNECT_SECONDS = Histogram('spug_ssh_connect_seconds', 'SSH 连接握手耗时', ['engine'])
+SSH_COMMAND_SECONDS = Histogram(
+    'spug_ssh_command_seconds', 'SSH 命令执行耗时', ['method'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+)
+DEPLOY_STEP_SECONDS = Histogram(
+    'spug_deploy_step_seconds', '发布/构建各步骤耗时', ['kind', 'target', 'step'],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+MONITOR_PROBE_SECONDS = Histogram('spug_monitor_probe_seconds', '监控探测耗时', ['type', 'result'])
+HTTP_PHASE_SECONDS = Histogram('spug_monitor_http_phase_seconds', '站点检测建立连接与首字节耗时', ['phase'])
+NOTIFY_FAILURES = Counter('spug_notify_failures_total', '通知发送失败次数', ['mode'])
+REDIS_COMMANDS = Counter('spug_redis_commands_total', 'Redis 命令调用次数', ['command'])
+VIEW_DB_QUERIES = Histogram(
+    'spug_view_db_queries', '单次请求的数据库查询数', ['view', 'method'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+JOB_WAIT_SECONDS = Histogram(
+    'spug_worker_job_wait_seconds', 'runworker 任务排队耗时', ['queue'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+)
+JOB_EXEC_SECONDS = Histogram(
+    'spug_worker_job_exec_seconds', 'runworker 任务执行耗时', ['queue'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+)
+
+
+class timer:
+    def __init__(self, histogram, **labels):
+        self.histogram = histogram.labels(**labels) if labels else histogram
+        self.flag = None
+
+    def __enter__(self):
+        self.flag = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.time() - self.flag)
+
+
+# 统计 Redis 命令调用次数，通过 DJANGO_REDIS_CONNECTION_FACTORY 启用
+class RedisConnection(Connection):
+    @staticmethod
+    def _count(command):
+        command = command.decode() if isinstance(command, bytes) else str(command)
+        REDIS_COMMANDS.labels(command.split(' ', 1)[0].upper()).inc()
+
+    def pack_command(self, *args):
+        self._count(args[0])
+        return super().pack_command(*args)
+
+    def pack_commands(self, commands):
+        commands = list(commands)
+        for item in commands:
+            self._count(item[0])
+        return super().pack_commands(commands)
+
+
+class RedisConnectionFactory(ConnectionFactory):
+    def get_connection_pool(self, params):
+        # unix socket 等其他连接方式保持默认
+        if params.get('url', '').startswith('redis://'):
+            params = dict(params, connection_class=RedisConnection)
+        return super().get_connection_pool(params)
+
+
+# 统计每个视图单次请求的数据库查询数
+class DBQueryMiddleware(MiddlewareMixin):
+    def process_request(self, request):
+        def wrapper(execute, sql, params, many, context):
+            request.db_queries += 1
+            return execute(sql, params, many, context)
+
+        request.db_queries = 0
+        request.db_wrapper = wrapper
+        connection.execute_wrappers.append(wrapper)
+
+    def process_response(self, request, response):
+        wrapper = getattr(request, 'db_wrapper', None)
+        if wrapper in connection.execute_wrappers:
+            connection.execute_wrappers.remove(wrapper)
+            match = request.resolver_match
+            view = match.view_name if match else 'unknown'
+            VIEW_DB_QUERIES.labels(view, request.method).observe(request.db_queries)
+        return response
+
+
+class QueueCollector:
+    # 采集时从 Redis 读取各队列的积压数、执行中任务数及最早任务的等待时长
+    def collect(self):
+        from django_redis import get_redis_connection
+        from libs import jobqueue
+        queues = {
+            'exec': settings.EXEC_WORKER_KEY,
+            'schedule': settings.SCHEDULE_WORKER_KEY,
+            'monitor': settings.MONITOR_WORKER_KEY
+        }
+        depth = GaugeMetricFamily('spug_worker_queue_depth', '队列中等待分配的任务数', labels=['queue'])
+        pending = GaugeMetricFamily('spug_worker_queue_pending', '已分配给 worker 未确认的任务数', labels=['queue'])
+        workers = GaugeMetricFamily('spug_worker_alive', '存活的 worker 数', labels=['queue'])
+        lag = GaugeMetricFamily('spug_worker_queue_lag_seconds', '队列中最早任务的等待时长', labels=['queue'])
+        try:
+            rds = get_redis_connection()
+            stats = jobqueue.get_stats(rds, queues.values())
+            for name, key in queues.items():
+                depth.add_metric([name], stats[key]['depth'])
+                pending.add_metric([name], stats[key]['pending'])
+                workers.add_metric([name], stats[key]['workers'])
+                entries = rds.xrange(key, count=1)
+                oldest = int(entries[0][0].split(b'-')[0]) / 1000 if entries else time.time()
+                lag.add_metric([name], max(0.0, time.time() - oldest))
+        except Exception as e:
+            logging.warning(f'collect queue metrics failed: {e}')
+        return [depth, pending, workers, lag]
+
+
+class DefaultCollector:
+    def collect(self):
+        return REGISTRY.collect()
+
+
+def generate(with_queues=False):
+    registry = CollectorRegistry()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(DefaultCollector())
+    if with_queues:
+        registry.register(QueueCollector())
+    return generate_latest(registry)
+
+
+def start_server(name, port=None):
+    # 为独立运行的后台进程启动采集端口，未配置时不启动
+    port = port or settings.METRICS_PORTS.get(name)
+    if port:
+        start_http_server(int(port), addr=settings.METRICS_ADDR)
+        logging.warning(f'metrics server listening on {settings.METRICS_ADDR}:{port}')
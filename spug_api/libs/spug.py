@@ -7,6 +7,7 @@ from apps.notify.models import Notify
 from libs.mail import Mail
 from libs.utils import human_datetime
 from libs.push import push_server
+from libs.metrics import NOTIFY_FAILURES
 import requests
 import json
 
@@ -26,8 +27,10 @@ class Notification:
         try:
             res = requests.post(url, json=data, timeout=15)
         except Exception as e:
+            NOTIFY_FAILURES.labels(mode or 'unknown').inc()
             return Notify.make_system_notify('通知发送失败', f'接口调用异常: {e}')
         if res.status_code != 200:
+            NOTIFY_FAILURES.labels(mode or 'unknown').inc()
             return Notify.make_system_notify('通知发送失败', f'返回状态码：{res.status_code}, 请求URL：{res.url}')
 
         if mode in ['dd', 'wx']:
@@ -44,6 +47,7 @@ class Notification:
                 return
         else:
             raise NotImplementedError
+        NOTIFY_FAILURES.labels(mode).inc()
         Notify.make_system_notify('通知发送失败', f'返回数据：{res}')
 
     def monitor_by_email(self, users):
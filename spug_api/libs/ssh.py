@@ -3,11 +3,24 @@
 # Released under the AGPL-3.0 License.
 from paramiko.client import SSHClient, AutoAddPolicy
 from paramiko.rsakey import RSAKey
+from paramiko.ecdsakey import ECDSAKey
+from paramiko.ed25519key import Ed25519Key
 from paramiko.auth_handler import AuthHandler
 from paramiko.ssh_exception import AuthenticationException, SSHException
 from paramiko.py3compat import b, u
+from paramiko.message import Message
+from base64 import b64encode
+from collections import deque
+from functools import lru_cache
+from hashlib import sha256
 from io import StringIO
 from uuid import uuid4
+from libs.metrics import timer, SSH_CONNECT_SECONDS, SSH_COMMAND_SECONDS
+import threading
+import asyncssh
+import asyncio
+import codecs
+import struct
 import time
 import re
 
@@ -49,24 +62,306 @@ def _finalize_pubkey_algorithm(self, key_type):
 AuthHandler._finalize_pubkey_algorithm = _finalize_pubkey_algorithm
 
 
+# 按密钥内容缓存解析后的私钥对象，相同的全局密钥在批量执行时只需解析一次
+@lru_cache(maxsize=256)
+def load_private_key(pkey):
+    for key_class in (RSAKey, Ed25519Key, ECDSAKey):
+        try:
+            return key_class.from_private_key(StringIO(pkey))
+        except SSHException:
+            continue
+    raise SSHException('not a valid RSA/Ed25519/ECDSA private key')
+
+
+@lru_cache(maxsize=256)
+def load_async_private_key(pkey):
+    return asyncssh.import_private_key(pkey)
+
+
+# 增量解码，默认UTF-8，遇到非法字节后剩余内容按GBK解码
+class StreamDecoder:
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def decode(self, data, final=False):
+        # 与 _decode 一样按段回退：仅解码失败的这一段按 GBK 解码，之后的输出仍按 UTF-8 解码
+        state = self.decoder.getstate()
+        try:
+            return self.decoder.decode(data, final)
+        except UnicodeDecodeError:
+            self.decoder.reset()
+            return (state[0] + data).decode('GBK', errors='ignore')
+
+
+# 增量解析命令输出，跨越多次recv的多字节字符与结束标记都能被正确识别
+class StreamParser:
+    def __init__(self, eof):
+        self.eof = eof
+        self.exit_code = -1
+        self.is_done = False
+        self.regex = re.compile(rf'{re.escape(eof)} (-?\d+)\r?\n')
+        self.loose_regex = re.compile(rf'{re.escape(eof)} (-?\d+)')
+        self.partial_regex = re.compile(r' -?\d*\r?')
+        self.decoder = StreamDecoder()
+        self.tail = ''
+
+    def feed(self, data):
+        if self.is_done:
+            return ''
+        text = self.tail + self.decoder.decode(data)
+        match = self.regex.search(text)
+        if match:
+            return self._done(text, match)
+        index = self._partial_index(text)
+        self.tail = text[index:]
+        return text[:index]
+
+    def finish(self):
+        if self.is_done:
+            return ''
+        text = self.tail + self.decoder.decode(b'', True)
+        match = self.loose_regex.search(text)
+        if match:
+            return self._done(text, match)
+        self.tail = ''
+        return text
+
+    def _done(self, text, match):
+        self.is_done = True
+        self.exit_code = int(match.group(1))
+        self.tail = ''
+        return text[:match.start()]
+
+    def _partial_index(self, text):
+        # 仅保留可能是结束标记前缀的尾部，其余内容立即输出
+        size = len(self.eof)
+        start = text.find(self.eof[0], max(0, len(text) - size - 16))
+        while start != -1:
+            rest = text[start:]
+            if self.eof.startswith(rest):
+                return start
+            if rest.startswith(self.eof) and self.partial_regex.fullmatch(rest[size:]):
+                return start
+            start = text.find(self.eof[0], start + 1)
+        return len(text)
+
+
+# 进程内共享的SSH连接池，按 (hostname, port, username, 凭据指纹) 复用已认证的连接，避免每次操作都重新握手
+class ConnectionPool:
+    def __init__(self, max_per_host=8, idle_timeout=300, keepalive=30, wait_timeout=60):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.wait_timeout = wait_timeout
+        self.counter = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._idle = {}
+        self._busy = {}
+        self._cond = threading.Condition()
+        self._reaper = None
+
+    @staticmethod
+    def make_key(arguments):
+        pkey, password = arguments.get('pkey'), arguments.get('password')
+        if pkey:
+            fingerprint = pkey.get_fingerprint().hex()
+        elif password:
+            fingerprint = sha256(password.encode()).hexdigest()
+        else:
+            fingerprint = None
+        return arguments['hostname'], arguments['port'], arguments['username'], fingerprint
+
+    @staticmethod
+    def is_healthy(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active() and transport.is_authenticated()
+
+    def acquire(self, key, factory):
+        deadline = time.time() + self.wait_timeout
+        with self._cond:
+            while True:
+                idle = self._idle.get(key)
+                while idle:
+                    client, last_used = idle.pop()
+                    if time.time() - last_used < self.idle_timeout and self.is_healthy(client):
+                        self.counter['hits'] += 1
+                        self._busy[key] = self._busy.get(key, 0) + 1
+                        return client
+                    self.counter['evictions'] += 1
+                    client.close()
+                if self._busy.get(key, 0) < self.max_per_host:
+                    self.counter['misses'] += 1
+                    self._busy[key] = self._busy.get(key, 0) + 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SSHException(f'Wait for idle connection of {key[0]}:{key[1]} timeout')
+                self._cond.wait(remaining)
+
+        try:
+            client = factory()
+            client.get_transport().set_keepalive(self.keepalive)
+            return client
+        except Exception:
+            self._release_slot(key)
+            raise
+
+    def release(self, key, client):
+        if self.is_healthy(client):
+            with self._cond:
+                self._idle.setdefault(key, deque()).append((client, time.time()))
+                self._busy[key] -= 1
+                self._cond.notify_all()
+            self._start_reaper()
+        else:
+            client.close()
+            self._release_slot(key)
+
+    def evict_expired(self):
+        expired, now = [], time.time()
+        with self._cond:
+            for key, idle in self._idle.items():
+                while idle and now - idle[0][1] >= self.idle_timeout:
+                    expired.append(idle.popleft()[0])
+            self._idle = {k: v for k, v in self._idle.items() if v}
+            self.counter['evictions'] += len(expired)
+        for client in expired:
+            client.close()
+
+    def clear(self):
+        with self._cond:
+            clients = [x[0] for idle in self._idle.values() for x in idle]
+            self._idle = {}
+        for client in clients:
+            client.close()
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                self.counter,
+                idle=sum(len(x) for x in self._idle.values()),
+                busy=sum(self._busy.values()),
+            )
+
+    def _release_slot(self, key):
+        with self._cond:
+            self._busy[key] -= 1
+            if not self._busy[key]:
+                self._busy.pop(key)
+            self._cond.notify_all()
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            with self._cond:
+                if self._reaper is None:
+                    self._reaper = threading.Thread(target=self._reap, daemon=True)
+                    self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 2))
+            self.evict_expired()
+
+
+connection_pool = ConnectionPool()
+
+
+# 通过 agent 转发提供给远端的最小 ssh-agent，只提供一个私钥且最多签名 max_signs 次，远端可用其认证但无法读取私钥
+class KeyAgent:
+    FAILURE = 5
+    REQUEST_IDENTITIES = 11
+    IDENTITIES_ANSWER = 12
+    SIGN_REQUEST = 13
+    SIGN_RESPONSE = 14
+    RSA_SHA2_256 = 2
+    RSA_SHA2_512 = 4
+
+    def __init__(self, pkey, max_signs=4):
+        self.pkey = load_private_key(pkey) if isinstance(pkey, str) else pkey
+        self.blob = self.pkey.asbytes()
+        self.signs = max_signs
+        self.lock = threading.Lock()
+
+    def __call__(self, channel):
+        # 由 paramiko 的传输线程调用，需在独立线程中处理该 agent 连接
+        threading.Thread(target=self.serve, args=(channel,), daemon=True).start()
+
+    def serve(self, channel):
+        try:
+            while True:
+                size = struct.unpack('>I', self._recv(channel, 4))[0]
+                if size > 256 * 1024:
+                    break
+                reply = self._handle(Message(self._recv(channel, size)))
+                channel.sendall(struct.pack('>I', len(reply)) + reply)
+        except (EOFError, OSError, SSHException):
+            pass
+        finally:
+            channel.close()
+
+    @staticmethod
+    def _recv(channel, size):
+        data = b''
+        while len(data) < size:
+            chunk = channel.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def _handle(self, msg):
+        tp, reply = ord(msg.get_byte()), Message()
+        if tp == self.REQUEST_IDENTITIES:
+            reply.add_byte(bytes([self.IDENTITIES_ANSWER]))
+            reply.add_int(1)
+            reply.add_string(self.blob)
+            reply.add_string('spug')
+            return reply.asbytes()
+        if tp == self.SIGN_REQUEST:
+            blob, data, flags = msg.get_binary(), msg.get_binary(), msg.get_int()
+            with self.lock:
+                allowed = blob == self.blob and self.signs > 0
+                self.signs -= 1 if allowed else 0
+            if allowed:
+                if isinstance(self.pkey, RSAKey):
+                    if flags & self.RSA_SHA2_512:
+                        signature = self.pkey.sign_ssh_data(data, 'rsa-sha2-512')
+                    elif flags & self.RSA_SHA2_256:
+                        signature = self.pkey.sign_ssh_data(data, 'rsa-sha2-256')
+                    else:
+                        signature = self.pkey.sign_ssh_data(data, 'ssh-rsa')
+                else:
+                    signature = self.pkey.sign_ssh_data(data)
+                reply.add_byte(bytes([self.SIGN_RESPONSE]))
+                reply.add_string(signature.asbytes())
+                return reply.asbytes()
+        return bytes([self.FAILURE])
+
+
 class SSH:
+    # 单行命令需低于终端规范模式下 4096 字节的行长限制，超出的脚本回退为上传文件后执行
+    inline_limit = 3072
+    init_command = '[ -n "$BASH_VERSION" ] && set +o history\n' \
+                   '[ -n "$ZSH_VERSION" ] && set +o zle && set -o no_nomatch\n' \
+                   'export PS1= && stty -echo\n'
+
     def __init__(self, hostname, port=22, username='root', pkey=None, password=None, default_env=None,
-                 connect_timeout=10, term=None):
-        self.stdout = None
+                 connect_timeout=10, term=None, pooled=False):
         self.client = None
+        self.pooled = pooled
+        self.pool_key = None
         self.channel = None
         self.sftp = None
         self.exec_file = None
         self.term = term or {}
         self.eof = 'Spug EOF 2108111926'
         self.default_env = default_env
-        self.regex = re.compile(r'Spug EOF 2108111926 (-?\d+)[\r\n]?')
+        self.private_key = pkey if isinstance(pkey, str) else None
         self.arguments = {
             'hostname': hostname,
             'port': port,
             'username': username,
             'password': password,
-            'pkey': RSAKey.from_private_key(StringIO(pkey)) if isinstance(pkey, str) else pkey,
+            'pkey': load_private_key(pkey) if isinstance(pkey, str) else pkey,
             'timeout': connect_timeout,
             'allow_agent': False,
             'look_for_keys': False,
@@ -83,11 +378,56 @@ class SSH:
     def get_client(self):
         if self.client is not None:
             return self.client
-        self.client = SSHClient()
-        self.client.set_missing_host_key_policy(AutoAddPolicy)
-        self.client.connect(**self.arguments)
+        if self.pooled:
+            self.pool_key = connection_pool.make_key(self.arguments)
+            self.client = connection_pool.acquire(self.pool_key, self._connect)
+        else:
+            self.client = self._connect()
         return self.client
 
+    def close(self):
+        if self.client is None:
+            return
+        self._close_session()
+        if self.pooled:
+            connection_pool.release(self.pool_key, self.client)
+        else:
+            self.client.close()
+        self.client = None
+
+    def _connect(self):
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy)
+        with timer(SSH_CONNECT_SECONDS, engine='paramiko'):
+            client.connect(**self.arguments)
+        return client
+
+    async def connect_async(self, **kwargs):
+        # 基于 asyncssh 的连接，供事件循环中运行的批量执行与 Web 终端使用
+        arguments = self.arguments
+        client_keys = [load_async_private_key(self.private_key)] if self.private_key else ()
+        with timer(SSH_CONNECT_SECONDS, engine='asyncssh'):
+            return await asyncio.wait_for(asyncssh.connect(
+                arguments['hostname'],
+                port=arguments['port'],
+                username=arguments['username'],
+                password=arguments['password'],
+                client_keys=client_keys,
+                known_hosts=None,
+                agent_path=None,
+                **kwargs
+            ), arguments['timeout'])
+
+    def _close_session(self):
+        # 关闭交互shell与sftp，连接归还连接池后可被复用，远端的 trap 会清理临时执行文件
+        for item in (self.channel, self.sftp):
+            if item is not None:
+                try:
+                    item.close()
+                except Exception:
+                    pass
+        self.channel = self.sftp = self.exec_file = None
+
     def ping(self):
         return True
 
@@ -100,28 +440,39 @@ class SSH:
             raise Exception(f'add public key error: {out}')
 
     def exec_command_raw(self, command, environment=None):
-        channel = self.client.get_transport().open_session()
-        if environment:
-            channel.update_environment(environment)
-        channel.set_combine_stderr(True)
-        channel.exec_command(command)
-        code, output = channel.recv_exit_status(), channel.recv(-1)
+        with timer(SSH_COMMAND_SECONDS, method='raw'):
+            channel = self.client.get_transport().open_session()
+            if environment:
+                channel.update_environment(environment)
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            code, output = channel.recv_exit_status(), channel.recv(-1)
+        return code, self._decode(output)
+
+    def exec_command_with_agent(self, command, pkey):
+        # 开启 agent 转发执行命令，远端通过转发的 agent 使用 pkey 认证其他主机，私钥不会写入远端
+        # 转发处理器绑定在整个连接上，仅用于非连接池的连接
+        with timer(SSH_COMMAND_SECONDS, method='raw'):
+            channel = self.client.get_transport().open_session()
+            channel.request_forward_agent(KeyAgent(pkey))
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            code, output = channel.recv_exit_status(), channel.recv(-1)
         return code, self._decode(output)
 
     def exec_command(self, command, environment=None):
-        channel = self._get_channel()
-        command = self._handle_command(command, environment)
-        channel.sendall(command)
-        out, exit_code = '', -1
-        for line in self.stdout:
-            match = self.regex.search(line)
-            if match:
-                exit_code = int(match.group(1))
-                line = line[:match.start()]
-                out += line
-                break
-            out += line
-        return exit_code, out
+        with timer(SSH_COMMAND_SECONDS, method='shell'):
+            channel = self._get_channel()
+            command = self._handle_command(command, environment)
+            channel.sendall(command)
+            parser, out = StreamParser(self.eof), ''
+            while not parser.is_done:
+                data = channel.recv(8196)
+                if not data:
+                    out += parser.finish()
+                    break
+                out += parser.feed(data)
+        return parser.exit_code, out
 
     def _win_exec_command_with_stream(self, command, environment=None):
         channel = self.client.get_transport().open_session()
@@ -138,21 +489,22 @@ class SSH:
         yield channel.recv_exit_status(), self._decode(out)
 
     def exec_command_with_stream(self, command, environment=None):
-        channel = self._get_channel()
-        command = self._handle_command(command, environment)
-        channel.sendall(command)
-        exit_code, line = -1, ''
-        while True:
-            line = self._decode(channel.recv(8196))
-            if not line:
-                break
-            match = self.regex.search(line)
-            if match:
-                exit_code = int(match.group(1))
-                line = line[:match.start()]
-                break
-            yield exit_code, line
-        yield exit_code, line
+        with timer(SSH_COMMAND_SECONDS, method='stream'):
+            channel = self._get_channel()
+            command = self._handle_command(command, environment)
+            channel.sendall(command)
+            parser, line = StreamParser(self.eof), ''
+            while True:
+                data = channel.recv(8196)
+                if not data:
+                    line = parser.finish()
+                    break
+                line = parser.feed(data)
+                if parser.is_done:
+                    break
+                if line:
+                    yield parser.exit_code, line
+        yield parser.exit_code, line
 
     def put_file(self, local_path, remote_path, callback=None):
         sftp = self._get_sftp()
@@ -162,6 +514,16 @@ class SSH:
         sftp = self._get_sftp()
         sftp.putfo(fl, remote_path, callback=callback, confirm=False)
 
+    def put_file_content(self, content, remote_path):
+        sftp = self._get_sftp()
+        with sftp.open(remote_path, 'w') as f:
+            f.write(content)
+
+    def get_file_content(self, remote_path):
+        sftp = self._get_sftp()
+        with sftp.open(remote_path, 'r') as f:
+            return f.read()
+
     def list_dir_attr(self, path):
         sftp = self._get_sftp()
         return sftp.listdir_attr(path)
@@ -180,17 +542,13 @@ class SSH:
 
         counter = 0
         self.channel = self.client.invoke_shell(**self.term)
-        command = '[ -n "$BASH_VERSION" ] && set +o history\n'
-        command += '[ -n "$ZSH_VERSION" ] && set +o zle && set -o no_nomatch\n'
-        command += 'export PS1= && stty -echo\n'
-        command = self._handle_command(command, self.default_env)
+        command = self._handle_command(self.init_command, self.default_env)
         self.channel.sendall(command)
-        out = ''
+        parser = StreamParser(self.eof)
         while True:
             if self.channel.recv_ready():
-                out += self._decode(self.channel.recv(8196))
-                if self.regex.search(out):
-                    self.stdout = self.channel.makefile('r')
+                parser.feed(self.channel.recv(8196))
+                if parser.is_done:
                     break
             elif counter >= 100:
                 self.client.close()
@@ -219,17 +577,31 @@ class SSH:
         str_envs = ' '.join(str_envs)
         return f'export {str_envs}'
 
+    def _make_script(self, command, environment):
+        script = ''
+        env_command = self._make_env_command(environment)
+        if env_command:
+            script += f'{env_command}\n'
+        script += command
+        script += f'\necho {self.eof} $?\n'
+        return script
+
+    def _make_inline_command(self, script):
+        # 较小的脚本以base64单行形式直接经shell通道执行，省去一次sftp写文件的往返
+        encoded = b64encode(script.encode()).decode()
+        if len(encoded) <= self.inline_limit:
+            return f'eval "$(printf %s {encoded} | base64 -d)"\n'
+
     def _handle_command(self, command, environment):
-        new_command = commands = ''
+        commands = ''
+        new_command = self._make_script(command, environment)
+        inline_command = self._make_inline_command(new_command)
+        if inline_command:
+            return inline_command
+
         if not self.exec_file:
             self.exec_file = f'/tmp/spug.{uuid4().hex}'
             commands += f'trap \'rm -f {self.exec_file}\' EXIT\n'
-
-        env_command = self._make_env_command(environment)
-        if env_command:
-            new_command += f'{env_command}\n'
-        new_command += command
-        new_command += f'\necho {self.eof} $?\n'
         self.put_file_by_fl(StringIO(new_command), self.exec_file)
         commands += f'. {self.exec_file}\n'
         return commands
@@ -250,5 +622,4 @@ class SSH:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.client.close()
-        self.client = None
+        self.close()
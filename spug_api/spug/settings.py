@@ -52,6 +52,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'libs.metrics.DBQueryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.middleware.common.CommonMiddleware',
     'libs.middleware.AuthenticationMiddleware',
@@ -84,6 +85,9 @@ CACHES = {
     }
 }
 
+# 使用自定义的连接类统计 Redis 命令调用次数
+DJANGO_REDIS_CONNECTION_FACTORY = 'libs.metrics.RedisConnectionFactory'
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -108,13 +112,62 @@ SCHEDULE_KEY = 'spug:schedule'
 SCHEDULE_WORKER_KEY = 'spug:schedule:worker'
 MONITOR_KEY = 'spug:monitor'
 MONITOR_WORKER_KEY = 'spug:monitor:worker'
+MONITOR_HISTORY_KEY = 'spug:monitor:history'
 EXEC_WORKER_KEY = 'spug:exec:worker'
+WORKER_GROUP = 'spug:worker'
+WORKER_ALIVE_KEY = 'spug:worker:alive'
 REQUEST_KEY = 'spug:request'
 BUILD_KEY = 'spug:build:repo'
 BUILD_IMAGE_KEY = 'spug:build:image'
 REPOS_DIR = os.path.join(os.path.dirname(os.path.dirname(BASE_DIR)), 'repos')
 BUILD_DIR = os.path.join(REPOS_DIR, 'build')
+BUILD_CACHE_DIR = os.path.join(BUILD_DIR, '.cache')
+BUILD_CACHE_SIZE = 20 * 1024 * 1024 * 1024
 TRANSFER_DIR = os.path.join(BASE_DIR, 'storage', 'transfer')
+# 结束的发布/构建日志压缩归档至此目录，Redis 中仅保留运行中的日志
+LOG_ARCHIVE_DIR = os.path.join(BASE_DIR, 'storage', 'logs')
+LOG_ARCHIVE_SEGMENT = 10000
+# 归档失败时日志在 Redis 中的保留时间
+LOG_EXPIRE = 14 * 24 * 60 * 60
+# 批量执行引擎：threads（paramiko + 线程）或 asyncio（asyncssh + 事件循环）
+EXEC_WORKER_ENGINE = 'threads'
+EXEC_ASYNC_CONCURRENCY = 1000
+EXEC_ASYNC_TIMEOUT = None
+# runworker 中各类队列的最大并发数、预取的排队任务数，及单个用户同时批量执行的主机数上限（默认 0 表示不限制，
+# 多用户共用时可设置为小于 exec 并发数的值，避免单个用户的大批量执行占满执行池）
+WORKER_CONCURRENCY = {'exec': 200, 'schedule': 100, 'monitor': 200}
+WORKER_PREFETCH = {'exec': 1000, 'schedule': 100, 'monitor': 200}
+EXEC_USER_QUOTA = 0
+# 监控检测引擎：threads（每个目标一个任务）或 asyncio（同一检测的站点/端口/Ping 目标合并后并发检测）
+MONITOR_PROBE_ENGINE = 'threads'
+MONITOR_ASYNC_CONCURRENCY = 2000
+# 站点检测共享的 HTTP 连接池：最大连接数、单个源站最大连接数、DNS 缓存秒数、空闲长连接保持秒数
+# MONITOR_HTTP_METHOD 可设为 HEAD 以避免下载响应内容，不支持时自动改用 GET
+MONITOR_HTTP_MAX_CONNECTIONS = 500
+MONITOR_HTTP_MAX_PER_HOST = 10
+MONITOR_HTTP_DNS_TTL = 300
+MONITOR_HTTP_KEEPALIVE = 300
+MONITOR_HTTP_CONNECT_TIMEOUT = 10
+MONITOR_HTTP_READ_TIMEOUT = 30
+MONITOR_HTTP_METHOD = 'GET'
+# 批量 Ping：每个目标发送的报文数，关闭后逐个执行 ping 命令
+MONITOR_PING_SWEEP = True
+MONITOR_PING_COUNT = 3
+# 进程、自定义脚本检测在该时间窗口（秒）内到期的按主机合并，通过一次 SSH 会话执行，设为 0 则逐个执行
+# 每个检测的输出最多保留 MONITOR_SSH_OUTPUT_LIMIT 字节
+MONITOR_SSH_BATCH_WINDOW = 10
+MONITOR_SSH_OUTPUT_LIMIT = 4096
+# 监控结果历史，按 (精度秒数, 槽位数) 降采样存储，默认 1 分钟精度保留 7 天、1 小时精度保留 1 年
+MONITOR_HISTORY_RESOLUTIONS = ((60, 7 * 24 * 60), (3600, 365 * 24))
+# Prometheus 指标：/metrics/ 需携带 Authorization: Bearer <METRICS_TOKEN>，未设置时不开放
+# 后台进程的采集端口，例如 {'runworker': 9101, 'runmonitor': 9102, 'runscheduler': 9103}
+METRICS_TOKEN = None
+METRICS_ADDR = '127.0.0.1'
+METRICS_PORTS = {}
+# 常规发布的构建包分发树的分叉数，0 表示由 Spug 直接上传至每台主机
+DEPLOY_FANOUT = 0
+# 常规发布时以主机上的上一版本为基准增量传输构建包
+DEPLOY_DELTA = False
 
 # Internationalization
 # https://docs.djangoproject.com/en/2.2/topics/i18n/
@@ -132,6 +185,7 @@ USE_TZ = False
 AUTHENTICATION_EXCLUDES = (
     '/account/login/',
     '/setting/basic/',
+    '/metrics/',
     re.compile('/apis/.*'),
 )
 
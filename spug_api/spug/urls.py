@@ -17,6 +17,7 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.urls import path, include
+from apps.setting.views import get_metrics
 
 urlpatterns = [
     path('account/', include('apps.account.urls')),
@@ -35,4 +36,5 @@ urlpatterns = [
     path('notify/', include('apps.notify.urls')),
     path('file/', include('apps.file.urls')),
     path('apis/', include('apps.apis.urls')),
+    path('metrics/', get_metrics),
 ]
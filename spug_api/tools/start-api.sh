@@ -8,4 +8,7 @@ cd $(dirname $(dirname $0))
 if [ -f ./venv/bin/activate ]; then
   source ./venv/bin/activate
 fi
+# gunicorn 多进程时各进程的 Prometheus 指标写入共享目录汇总
+export PROMETHEUS_MULTIPROC_DIR=/tmp/spug_metrics
+rm -rf $PROMETHEUS_MULTIPROC_DIR && mkdir -p $PROMETHEUS_MULTIPROC_DIR
 exec gunicorn -b 127.0.0.1:9001 -w 2 --threads 8 --access-logfile - spug.wsgi
@@ -0,0 +1,97 @@
+# Copyright: (c) OpenSpug Organization. https://github.com/openspug/spug
+# Copyright: (c) <spug.dev@gmail.com>
+# Released under the AGPL-3.0 License.
+# websocket 压测：建立大量空闲的日志/订阅 websocket，统计 websocket 服务进程每个连接占用的内存、线程及 Redis 连接数
+# 用法：python tools/ws-bench.py --pid <daphne 进程ID> --token <x-token> -n 1000 --path /ws/build/<token>/
+import argparse
+import asyncio
+import aiohttp
+import time
+import os
+
+
+def read_status(pid):
+    status = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            status[key] = value.strip()
+    return int(status['VmRSS'].split()[0]), int(status['Threads'])
+
+
+def redis_connections(pid, port):
+    # 统计进程到 Redis 端口的 TCP 连接数
+    inodes = set()
+    for fd in os.listdir(f'/proc/{pid}/fd'):
+        try:
+            link = os.readlink(f'/proc/{pid}/fd/{fd}')
+        except OSError:
+            continue
+        if link.startswith('socket:['):
+            inodes.add(link[8:-1])
+    count = 0
+    for name in ('tcp', 'tcp6'):
+        with open(f'/proc/{pid}/net/{name}') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if int(fields[2].split(':')[1], 16) == port and fields[9] in inodes:
+                    count += 1
+    return count
+
+
+async def hold(session, url, message, ready, stop):
+    # 模拟前端：收到 pong 后重新发起等待，保持连接空闲
+    async with session.ws_connect(url, heartbeat=None) as ws:
+        await ws.send_str(message)
+        ready.release()
+        while not stop.is_set():
+            try:
+                msg = await asyncio.wait_for(ws.receive(), 1)
+            except asyncio.TimeoutError:
+                continue
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            if msg.data == 'pong':
+                await ws.send_str(message)
+
+
+async def main(args):
+    url = f'{args.url.rstrip("/")}{args.path}?x-token={args.token}'
+    rss, threads = read_status(args.pid)
+    clients = redis_connections(args.pid, args.redis_port)
+    ready, stop = asyncio.Semaphore(0), asyncio.Event()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = []
+        for _ in range(args.number):
+            tasks.append(asyncio.ensure_future(hold(session, url, args.message, ready, stop)))
+            await asyncio.sleep(0)
+        flag = time.time()
+        for _ in range(args.number):
+            await asyncio.wait_for(ready.acquire(), 60)
+        connect_seconds = time.time() - flag
+        await asyncio.sleep(args.hold)
+        rss2, threads2 = read_status(args.pid)
+        clients2 = redis_connections(args.pid, args.redis_port)
+        alive = sum(1 for x in tasks if not x.done())
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    print(f'connections:       {args.number} (alive after {args.hold}s: {alive})')
+    print(f'connect time:      {connect_seconds:.2f}s')
+    print(f'server RSS:        {rss} KB -> {rss2} KB, {(rss2 - rss) / args.number:.1f} KB per connection')
+    print(f'server threads:    {threads} -> {threads2}')
+    print(f'redis connections: {clients} -> {clients2}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='websocket idle connection benchmark')
+    parser.add_argument('--url', default='ws://127.0.0.1:9002', help='websocket 服务地址')
+    parser.add_argument('--path', default='/ws/build/bench/', help='websocket 路径')
+    parser.add_argument('--token', required=True, help='用户的 access_token')
+    parser.add_argument('--pid', type=int, required=True, help='websocket 服务进程ID')
+    parser.add_argument('--message', default='0', help='建立连接后发送的消息')
+    parser.add_argument('--redis-port', type=int, default=6379, help='Redis 端口，用于统计服务进程的 Redis 连接数')
+    parser.add_argument('--hold', type=int, default=15, help='全部连接建立后保持的秒数')
+    parser.add_argument('-n', '--number', type=int, default=1000, help='连接数')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -27,7 +27,7 @@ const StatusMap = {
 }
 
 function CardItem(props) {
-  const {status, type, group, desc, name, target, latest_run_time} = props.data
+  const {status, type, group, desc, name, target, latency, latest_run_time} = props.data
   const title = (
     <div>
       <div>分组: {group}</div>
@@ -35,6 +35,7 @@ function CardItem(props) {
       <div>名称: {name}</div>
       <div>目标: {target}</div>
       <div>状态: {StatusMap[status]}</div>
+      {latency !== undefined && <div>延迟: {latency}ms</div>}
       <div>更新: {latest_run_time || '---'}</div>
       <div>描述: {desc}</div>
     </div>
@@ -16,7 +16,8 @@ import lds from 'lodash';
 
 const helpMap = {
   '1': '返回HTTP状态码200-399则判定为正常，其他为异常。',
-  '4': '脚本执行退出状态码为 0 则判定为正常，其他为异常。'
+  '4': '脚本执行退出状态码为 0 则判定为正常，其他为异常。',
+  '5': '全部报文丢失则判定为异常，设置平均延迟后超出时也判定为异常。'
 }
 
 export default observer(function () {
@@ -77,6 +78,7 @@ export default observer(function () {
     const {type, extra} = store.record;
     if (!Number(extra) > 0) {
       if (type === '1' && extra) return message.error('请输入正确的响应时间')
+      if (type === '5' && extra) return message.error('请输入正确的平均延迟')
       if (type === '2') return message.error('请输入正确的端口号')
     }
     store.page += 1;
@@ -138,6 +140,10 @@ export default observer(function () {
         <Input suffix="ms" value={extra} placeholder="最长响应时间（毫秒），不设置则默认10秒超时"
                onChange={e => store.record.extra = e.target.value}/>
       </Form.Item>
+      <Form.Item label="平均延迟" style={getStyle(['5'])}>
+        <Input suffix="ms" value={extra} placeholder="最长平均延迟（毫秒），不设置则仅检测是否可达"
+               onChange={e => store.record.extra = e.target.value}/>
+      </Form.Item>
       <Form.Item required label="检测端口" style={getStyle(['2'])}>
         <Input value={extra} placeholder="请输入端口号" onChange={e => store.record.extra = e.target.value}/>
       </Form.Item>
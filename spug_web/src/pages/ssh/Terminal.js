@@ -35,7 +35,10 @@ function WebSSH(props) {
     term.write('WebSocket connecting ... ');
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
     const socket = new WebSocket(`${protocol}//${window.location.host}/api/ws/ssh/${props.id}/?x-token=${X_TOKEN}`);
-    socket.onmessage = e => term.write(e.data)
+    // 每一帧渲染完成后回复 ack，服务端据此控制未确认的输出量
+    socket.onmessage = e => term.write(e.data, () => {
+      if (socket.readyState === 1) socket.send(JSON.stringify({ack: 1}))
+    })
     socket.onopen = () => {
       term.write('ok')
       term.focus();